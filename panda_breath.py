@@ -1,14 +1,18 @@
 # panda_breath.py — Klipper extras module for BIQU Panda Breath
 #
 # Exposes the Panda Breath as a standard Klipper heater (heater_generic interface).
-# Supports two firmware targets via a transport abstraction:
+# Supports three firmware targets via a transport abstraction:
 #
-#   firmware: stock   — OEM WebSocket JSON protocol (ws://<host>/ws)
-#                       Recommended firmware: v1.0.3+; v1.0.4 aliases supported
-#   firmware: esphome — ESPHome MQTT protocol (MQTT 3.1.1 over TCP)
+#   firmware: stock      — OEM WebSocket JSON protocol (ws://<host>/ws)
+#                          Recommended firmware: v1.0.3+; v1.0.4 aliases
+#                          supported
+#   firmware: stock_mqtt — OEM v1.0.4+ native MQTT client (JSON state and
+#                          commands through a local broker)
+#   firmware: esphome    — ESPHome MQTT protocol (MQTT 3.1.1 over TCP)
 #
-# No external Python dependencies — stdlib only (socket, struct, hashlib, base64,
-# os, json, threading, collections, time, logging).  The module is a single-file
+# No external Python dependencies — stdlib only (socket, selectors, errno,
+# struct, hashlib, base64, os, random, json, threading, collections,
+# contextlib, heapq, array, math, time, types, logging).  The module is a single-file
 # drop into /home/lava/klipper/klippy/extras/ with no install steps.
 #
 # printer.cfg — stock firmware:
@@ -36,90 +40,1750 @@
 #   mqtt_broker: 192.168.1.x
 #   mqtt_port: 1883
 #   mqtt_topic_prefix: panda-breath
+#
+# Further devices use named sections; [panda_breath left] registers the
+# chip and sensor type panda_breath_left (heater_pin: panda_breath_left:pwm).
+
+import array
+import collections
+import contextlib
+import base64
+import errno
+import hashlib
+import heapq
+import json
+import logging
+import math
+import os
+import random
+import selectors
+import socket
+import struct
+import threading
+import time
+import types
+
+logger = logging.getLogger(__name__)
+
+# Reconnect backoff: base and cap of the jittered delay, and how long a
+# connection must stay up before the backoff starts over (seconds)
+RECONNECT_BASE_DELAY = 1.
+RECONNECT_MAX_DELAY = 30.
+RECONNECT_STABLE = 30.
+# How often the Klipper reactor timer drains the state queue (seconds)
+REACTOR_POLL = 1.
+# Minimum spacing between event-driven reactor wake-ups (seconds)
+REACTOR_MIN_POLL = 0.05
+# Poll period while the device is off and nothing changes (seconds); kept
+# well under the 5 s after which heater_generic treats a reading as stale
+REACTOR_IDLE_POLL = 3.
+# Log a warning if no temperature update received within this window (seconds)
+TEMP_STALE_WARN = 60.
+# Retry period for resolving the heater when it could not be bound (seconds)
+REBIND_INTERVAL = 10.
+# Re-report the last reading once it is this old, so heater_generic (which
+# treats readings older than 5 s as 0) keeps a valid temperature (seconds)
+SAMPLE_HOLD = 2.
+# Default bound of each transport's outbound send queue (entries)
+SEND_QUEUE_SIZE = 16
+# Settings fields that start a new frame by default: each command goes out
+# in the stock web UI's order, which v1.0.3 firmware relies on
+SETTINGS_BARRIERS = (
+    "isrunning", "work_mode", "set_temp", "temp", "filtertemp",
+    "hotbedtemp", "custom_temp", "custom_timer", "filament_temp",
+    "filament_timer", "work_on",
+)
+# Hard upper bound on how long force_off may hold the reactor (seconds)
+OFF_DEADLINE = 1.
+# How long a resolved host name is reused before it is looked up again
+RESOLVE_TTL = 60.
+# Delay before racing the next resolved address (Happy Eyeballs, seconds)
+CONNECT_RACE_DELAY = .25
+# MQTT keepalive advertised in CONNECT; PINGREQ goes out every half of it
+MQTT_KEEPALIVE = 60.
+# Client id presented to the MQTT broker unless configured
+MQTT_CLIENT_ID = "panda_breath_klipper"
+# QoS 1 publishes awaiting PUBACK, and the retransmission timeout (seconds)
+MQTT_INFLIGHT = 4
+MQTT_RETRY_TIMEOUT = 2.
+# Raw temperature samples kept per device; the downsampled history tiers
+# are (bucket seconds, buckets kept): 10 min, 2 h and 24 h
+HISTORY_SIZE = 1800
+HISTORY_TIERS = ((1., 600), (10., 720), (60., 1440))
+# smoothed_temp filter defaults: EMA time constant (seconds), Kalman
+# process noise (°C² per second) and measurement noise (°C²), and the time
+# constant of the temperature_slope estimate (seconds)
+SMOOTH_TIME = 10.
+KALMAN_PROCESS_NOISE = .002
+KALMAN_MEASUREMENT_NOISE = .04
+SLOPE_TIME = 30.
+# Thermal model: fit step (seconds), RLS forgetting factor per step, the
+# band below the target in which the device regulates and samples are not
+# used (°C), and the steps of each input needed before a fit is trusted.
+# Forgetting stops while the covariance trace is above MODEL_COV_LIMIT, and
+# a step is not fitted when its mean temperature is within
+# MODEL_MIN_EXCITATION (°C) of the last fitted step with the same input and
+# the fit already predicts its change to within that much
+MODEL_STEP = 10.
+MODEL_FORGETTING = .999
+MODEL_REGULATION_BAND = 2.
+MODEL_MIN_STEPS = 12
+MODEL_COV_LIMIT = 3e3
+MODEL_MIN_EXCITATION = .02
+# PANDA_BREATH_WAIT: default tolerance around the target (°C) and the
+# spacing of its progress reports (seconds)
+WAIT_TOLERANCE = .5
+WAIT_REPORT_INTERVAL = 10.
+
+
+def _parse_bool(value):
+    """Return True/False for common JSON/HA values, or None if unknown."""
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        try:
+            return bool(int(value))
+        except Exception:
+            return None
+    if isinstance(value, str):
+        lowered = value.strip().lower()
+        if lowered in ("1", "true", "on", "yes"):
+            return True
+        if lowered in ("0", "false", "off", "no"):
+            return False
+    return None
+
+
+def _to_bool(value):
+    parsed = _parse_bool(value)
+    if parsed is None:
+        raise ValueError("not a boolean: %r" % (value,))
+    return parsed
+
+
+# Device state schema.  Each entry maps a normalised state field to the
+# device keys that carry it (aliases in order of preference) and the
+# converter applied on the I/O thread.  Entry order is also the order in
+# which PandaBreath applies fields, so mode changes land before the fields
+# they qualify.  A new firmware alias is one more key in the tuple.
+_STATE_FIELDS = (
+    # Receive time of the temperature sample (time.monotonic(), set by
+    # PandaBreath._enqueue rather than sent by the device)
+    ("temperature_time", (), float),
+    # ADC-calibrated reading first; v1.0.4 and raw aliases as fallback
+    ("temperature", ("cal_warehouse_temp", "chamber_temp",
+                     "warehouse_temper"), float),
+    ("work_mode", ("work_mode",), int),
+    ("work_on", ("work_on",), _to_bool),
+    ("set_temp", ("set_temp",), float),
+    ("target_temp", ("target_temp",), float),
+    ("heater_temp", ("heater_temp",), float),
+    ("auto_target", ("temp",), int),
+    ("auto_filtertemp", ("filtertemp", "filter_temp"), int),
+    ("auto_hotbedtemp", ("hotbedtemp",), int),
+    ("filament_temp", ("filament_temp", "custom_temp"), int),
+    ("filament_timer", ("filament_timer", "custom_timer"), int),
+    ("remaining_seconds", ("remaining_seconds",), int),
+    ("drying_remaining_min", ("drying_remaining_min",), int),
+    ("isrunning", ("isrunning",), _to_bool),
+    ("drying_running", ("drying_running",), _to_bool),
+    ("filament_drying_mode", ("filament_drying_mode",), lambda value: value),
+    ("filament_button", ("filament_button",), int),
+    # Reported only by the ESPHome firmware (fan topics)
+    ("fan_on", (), _to_bool),
+    ("fan_speed", (), int),
+)
+
+# device key → (state field, converter, alias preference), compiled once
+_SETTINGS_DECODER = {
+    key: (field, convert, preference)
+    for field, keys, convert in _STATE_FIELDS
+    for preference, key in enumerate(keys)
+}
+# state field → application order
+_FIELD_ORDER = {field: rank for rank, (field, _, _) in enumerate(_STATE_FIELDS)}
+
+
+def _decode_settings(settings):
+    """Map a device "settings" dict to typed state fields.
+
+    Cost is proportional to the keys present in the message.  When several
+    aliases of one field are present the preferred one wins; a value that
+    fails conversion is skipped so a lower-preference alias can fill in.
+    """
+    state = {}
+    preferences = {}
+    for key, raw in settings.items():
+        spec = _SETTINGS_DECODER.get(key)
+        if spec is None:
+            continue
+        field, convert, preference = spec
+        if preferences.get(field, preference + 1) < preference:
+            continue
+        try:
+            state[field] = convert(raw)
+        except (TypeError, ValueError):
+            continue
+        preferences[field] = preference
+    return state
+
+
+def _ws_mask(data, mask):
+    """Return data XOR-ed with the repeating 4-byte WebSocket mask.
+
+    Works word-wide: payload and repeated mask are converted to single big
+    integers, XOR-ed once and converted back, instead of a Python-level loop
+    per byte.  Shared with panda_breath_cli.py.
+    """
+    length = len(data)
+    if not length:
+        return b""
+    key = (bytes(mask) * ((length >> 2) + 1))[:length]
+    return (int.from_bytes(data, "little")
+            ^ int.from_bytes(key, "little")).to_bytes(length, "little")
+
+
+# ─── State hand-off between the I/O thread and the reactor ────────────────────
+
+class _StateStore:
+    """Coalescing latest-value store replacing an unbounded message queue.
+
+    The I/O thread put()s decoded state dicts; the reactor drain()s whatever
+    changed since the last drain.  Repeated values for a field overwrite
+    each other, so memory stays constant however long the reactor stalls,
+    and the overwritten intermediate values are counted as dropped.
+    Transitions of the ORDERED fields (mode and run-state flags) are not
+    merged away: a change to one of them seals the pending update into a
+    segment and the reactor applies segments in arrival order.  At most
+    max_segments are kept; beyond that the two oldest are merged.
+    """
+
+    ORDERED = frozenset(("work_mode", "work_on", "isrunning",
+                         "drying_running"))
+
+    def __init__(self, max_segments=8):
+        self._lock = threading.Lock()
+        self._max_segments = max_segments
+        self._segments = collections.deque()
+        self._pending = {}
+        self.seq = 0
+        self.dropped = 0
+
+    def put(self, state):
+        with self._lock:
+            pending = self._pending
+            for field in self.ORDERED.intersection(state):
+                if field in pending and pending[field] != state[field]:
+                    self._seal()
+                    pending = self._pending
+                    break
+            for field, value in state.items():
+                if field in pending:
+                    self.dropped += 1
+                pending[field] = value
+            self.seq += 1
+
+    def _seal(self):
+        self._segments.append(self._pending)
+        self._pending = {}
+        if len(self._segments) > self._max_segments:
+            oldest = self._segments.popleft()
+            newer = self._segments[0]
+            self.dropped += len(newer.keys() & oldest.keys())
+            oldest.update(newer)
+            self._segments[0] = oldest
+
+    def drain(self):
+        """Return the pending updates as a list of dicts, oldest first."""
+        with self._lock:
+            if not self._segments and not self._pending:
+                return []
+            updates = list(self._segments)
+            if self._pending:
+                updates.append(self._pending)
+            self._segments.clear()
+            self._pending = {}
+            return updates
+
+
+# ─── Device state record ──────────────────────────────────────────────────────
+
+class _DeviceState:
+    """Device state as applied by the reactor, with a version counter.
+
+    Every assignment that changes a field bumps `version` and records it
+    against that field, so readers can tell in O(1) whether anything
+    moved and list the fields changed since a version they already hold.
+    Field names are the get_status() keys.
+    """
+
+    FIELDS = (
+        "temperature", "target", "smoothed_temp", "connected", "work_mode",
+        "work_on", "device_target", "heater_temp", "auto_enabled",
+        "auto_target", "auto_filtertemp", "auto_hotbedtemp", "filament_temp",
+        "filament_timer", "remaining_seconds", "drying_remaining_min",
+        "filament_button", "filament_drying_active", "fan_on", "fan_speed",
+        "temperature_slope",
+    )
+    __slots__ = FIELDS + ("version", "changed")
+
+    def __init__(self):
+        self.temperature = 0.
+        self.target = 0.
+        self.smoothed_temp = 0.
+        self.connected = False
+        self.work_mode = 2
+        self.work_on = False
+        self.device_target = 0.
+        self.heater_temp = 0.
+        self.auto_enabled = False
+        self.auto_target = 45
+        self.auto_filtertemp = 30
+        self.auto_hotbedtemp = 80
+        self.filament_temp = 0
+        self.filament_timer = 0
+        self.remaining_seconds = 0
+        self.drying_remaining_min = 0
+        self.filament_button = 0
+        self.filament_drying_active = False
+        self.fan_on = False
+        self.fan_speed = 0
+        # Rate of change of smoothed_temp (°C per minute)
+        self.temperature_slope = 0.
+        self.version = 0
+        # field → version of its last change
+        self.changed = {}
+
+    def set(self, field, value):
+        old = getattr(self, field)
+        if old == value and type(old) is type(value):
+            return
+        setattr(self, field, value)
+        self.version += 1
+        self.changed[field] = self.version
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def delta(self, since):
+        """Fields changed after version `since`, with their current values."""
+        return {field: getattr(self, field)
+                for field, version in self.changed.items() if version > since}
+
+
+class _StateAttr:
+    """Attribute of the owning object stored in its `state` record."""
+
+    __slots__ = ("field",)
+
+    def __init__(self, field=None):
+        self.field = field
+
+    def __set_name__(self, owner, name):
+        if self.field is None:
+            self.field = name
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        return getattr(obj.state, self.field)
+
+    def __set__(self, obj, value):
+        obj.state.set(self.field, value)
+
+
+# ─── Temperature history ──────────────────────────────────────────────────────
+
+# Recorded mode: work_mode while the device is on, 0 while it is off
+HISTORY_MODES = {0: "off", 1: "auto", 2: "heat", 3: "dry"}
+
+
+class _HistoryTier:
+    """Ring of fixed-size buckets in preallocated arrays.
+
+    Each bucket holds the chamber temperature min/max/sum and sample
+    count, the heater temperature sum, and the last target and mode seen.
+    With period 0 every sample gets its own bucket (the raw tier).
+    """
+
+    def __init__(self, period, size):
+        self.period = period
+        self.size = size
+        self.count = 0
+        self._head = -1
+        self._bucket = None
+        self._start = array.array('d', bytes(8 * size))
+        self._min = array.array('f', bytes(4 * size))
+        self._max = array.array('f', bytes(4 * size))
+        self._sum = array.array('d', bytes(8 * size))
+        self._heater = array.array('d', bytes(8 * size))
+        self._n = array.array('L', bytes(array.array('L').itemsize * size))
+        self._target = array.array('f', bytes(4 * size))
+        self._mode = array.array('b', bytes(size))
+
+    def add(self, sample_time, temp, heater_temp, target, mode):
+        i = self._head
+        if self.period:
+            bucket = sample_time // self.period
+            if bucket == self._bucket:
+                self._min[i] = min(self._min[i], temp)
+                self._max[i] = max(self._max[i], temp)
+                self._sum[i] += temp
+                self._heater[i] += heater_temp
+                self._n[i] += 1
+                self._target[i] = target
+                self._mode[i] = mode
+                return
+            self._bucket = bucket
+            start = bucket * self.period
+        else:
+            start = sample_time
+        i = self._head = (i + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+        self._start[i] = start
+        self._min[i] = self._max[i] = temp
+        self._sum[i] = temp
+        self._heater[i] = heater_temp
+        self._n[i] = 1
+        self._target[i] = target
+        self._mode[i] = mode
+
+    def rows(self, since):
+        """Yield (start, min, max, mean, heater mean, target, mode, count)
+        for the buckets ending after `since`, newest first."""
+        i = self._head
+        for _ in range(self.count):
+            start = self._start[i]
+            if start + self.period < since:
+                return
+            n = self._n[i]
+            yield (start, self._min[i], self._max[i], self._sum[i] / n,
+                   self._heater[i] / n, self._target[i], self._mode[i], n)
+            i = (i - 1) % self.size
+
+
+class _History:
+    """Fixed-memory chamber temperature history of one device.
+
+    Samples are recorded at receipt time in a raw ring of `size` entries
+    and folded into the HISTORY_TIERS bucket rings as they arrive, so
+    memory is fixed at start-up and a query walks only its window.
+    """
+
+    def __init__(self, size=HISTORY_SIZE, tiers=HISTORY_TIERS):
+        self.tiers = [_HistoryTier(0., size)]
+        self.tiers.extend(_HistoryTier(period, count)
+                          for period, count in tiers)
+        self.samples = 0
+
+    def add(self, sample_time, temp, heater_temp, target, mode):
+        self.samples += 1
+        for tier in self.tiers:
+            tier.add(sample_time, temp, heater_temp, target, mode)
+
+    def tier(self, resolution):
+        for tier in self.tiers:
+            if tier.period == resolution:
+                return tier
+        return None
+
+    def select(self, seconds, max_rows):
+        """The finest tier that covers `seconds` in at most max_rows rows."""
+        for tier in self.tiers[1:]:
+            if (seconds / tier.period <= max_rows
+                    and seconds <= tier.period * tier.size):
+                return tier
+        return self.tiers[-1]
+
+
+# ─── Temperature smoothing ────────────────────────────────────────────────────
+
+class _PassFilter:
+    """smoothing: none — smoothed_temp follows the raw reading."""
+
+    __slots__ = ()
+
+    def reset(self, value):
+        return value
+
+    def update(self, value, dt):
+        return value
+
+
+class _EmaFilter:
+    """Exponential moving average with a time constant in seconds.
+
+    The weight of each sample follows the actual interval, so an irregular
+    report rate does not change the effective smoothing.
+    """
+
+    __slots__ = ("tau", "value")
+
+    def __init__(self, config):
+        self.tau = config.getfloat("smooth_time", SMOOTH_TIME, above=0.)
+        self.value = 0.
+
+    def reset(self, value):
+        self.value = value
+        return value
+
+    def update(self, value, dt):
+        self.value += (1. - math.exp(-dt / self.tau)) * (value - self.value)
+        return self.value
+
+
+class _KalmanFilter:
+    """1-D Kalman filter on a random-walk temperature model.
+
+    The variance grows by `q` per second between samples and each reading
+    has variance `r`, so long gaps trust the next reading more.
+    """
+
+    __slots__ = ("q", "r", "value", "variance")
+
+    def __init__(self, config):
+        self.q = config.getfloat(
+            "kalman_process_noise", KALMAN_PROCESS_NOISE, above=0.)
+        self.r = config.getfloat(
+            "kalman_measurement_noise", KALMAN_MEASUREMENT_NOISE, above=0.)
+        self.value = 0.
+        self.variance = self.r
+
+    def reset(self, value):
+        self.value = value
+        self.variance = self.r
+        return value
+
+    def update(self, value, dt):
+        variance = self.variance + self.q * dt
+        gain = variance / (variance + self.r)
+        self.value += gain * (value - self.value)
+        self.variance = (1. - gain) * variance
+        return self.value
+
+
+class _TempSmoother:
+    """Runs the configured filter on each sample and estimates the slope.
+
+    The slope is an exponentially weighted least-squares line through the
+    raw readings, with weights decaying over `slope_time` seconds.  The
+    weighted sums are kept relative to the newest sample, so both the
+    filter and the fit cost O(1) per sample.
+    """
+
+    FILTERS = {"ema": _EmaFilter, "kalman": _KalmanFilter, "none": None}
+
+    def __init__(self, config):
+        filter_class = config.getchoice("smoothing", self.FILTERS, "ema")
+        self.filter = (filter_class(config) if filter_class is not None
+                       else _PassFilter())
+        self.slope_time = config.getfloat(
+            "slope_time", SLOPE_TIME, above=0.)
+        self.value = 0.
+        # °C per second
+        self.slope = 0.
+        self._last_time = None
+        # Weighted sums of 1, t, t², x and t·x, t relative to _last_time
+        self._sw = self._st = self._stt = self._sx = self._stx = 0.
+
+    def update(self, sample_time, value):
+        if self._last_time is None:
+            self._last_time = sample_time
+            self._sw, self._sx = 1., value
+            self.value = self.filter.reset(value)
+            return self.value
+        dt = max(0., sample_time - self._last_time)
+        self._last_time = sample_time
+        self.value = self.filter.update(value, dt)
+        # Move the time origin to this sample, decay, then add it at t=0
+        decay = math.exp(-dt / self.slope_time)
+        sw, st, sx = self._sw, self._st, self._sx
+        self._stt = decay * (self._stt - 2. * dt * st + dt * dt * sw)
+        self._stx = decay * (self._stx - dt * sx)
+        self._st = decay * (st - dt * sw)
+        self._sw = decay * sw + 1.
+        self._sx = decay * sx + value
+        sw, st = self._sw, self._st
+        spread = self._stt * sw - st * st
+        if spread > 1e-9 * sw * sw:
+            self.slope = (self._stx * sw - st * self._sx) / spread
+        return self.value
+
+
+# ─── Thermal model ────────────────────────────────────────────────────────────
+
+class _ThermalModel:
+    """Online first-order model of the chamber temperature.
+
+        dT/dt = θ0 + θ1·u − θ2·T
+
+    u is 1 while the device heats flat out and 0 while it is off; samples
+    in the regulation band just below the target, where the device cycles
+    its heater, are skipped.  The parameters are fitted by recursive
+    least squares with a forgetting factor, on the smoothed temperature
+    every MODEL_STEP seconds.  From them: time constant 1/θ2, ambient
+    θ0/θ2, gain (heated rise above ambient) θ1/θ2, and the steady state
+    with the heater on, (θ0 + θ1)/θ2, which only needs heating data.
+
+    A long idle period repeats the same regressor, and forgetting alone
+    would then grow the covariance without bound until the fit overflows,
+    so such steps are skipped and the covariance trace is capped.
+    """
+
+    def __init__(self, step=MODEL_STEP, forgetting=MODEL_FORGETTING):
+        self.step = step
+        self.forgetting = forgetting
+        self.theta = [0., 0., 0.]
+        self.cov = [[1e3 if i == j else 0. for j in range(3)]
+                    for i in range(3)]
+        self.steps = [0, 0]
+        self._anchor = None
+        # Mean temperature of the last fitted step, per input
+        self._fitted = [None, None]
+
+    def update(self, sample_time, temp, heating):
+        """Feed one sample; heating is True, False or None (skip)."""
+        if heating is None:
+            self._anchor = None
+            return
+        u = 1. if heating else 0.
+        anchor = self._anchor
+        if (anchor is None or anchor[2] != u
+                or sample_time - anchor[0] > 3. * self.step):
+            self._anchor = (sample_time, temp, u)
+            return
+        dt = sample_time - anchor[0]
+        if dt < self.step:
+            return
+        self._anchor = (sample_time, temp, u)
+        mean = (temp + anchor[1]) / 2.
+        phi = [1., u, -mean]
+        y = (temp - anchor[1]) / dt
+        last = self._fitted[int(u)]
+        if (last is not None and abs(mean - last) < MODEL_MIN_EXCITATION
+                and abs(y - sum(self.theta[i] * phi[i] for i in range(3)))
+                * self.step < MODEL_MIN_EXCITATION):
+            return
+        self._fitted[int(u)] = mean
+        self._fit(phi, y)
+        self.steps[int(u)] += 1
+
+    def _fit(self, phi, y):
+        cov = self.cov
+        p_phi = [sum(cov[i][j] * phi[j] for j in range(3)) for i in range(3)]
+        lam = self.forgetting
+        if sum(cov[i][i] for i in range(3)) > MODEL_COV_LIMIT:
+            lam = 1.
+        denom = lam + sum(phi[i] * p_phi[i] for i in range(3))
+        gain = [v / denom for v in p_phi]
+        error = y - sum(self.theta[i] * phi[i] for i in range(3))
+        self.theta = [self.theta[i] + gain[i] * error for i in range(3)]
+        self.cov = [[(cov[i][j] - gain[i] * p_phi[j]) / lam
+                     for j in range(3)] for i in range(3)]
+
+    def fit(self):
+        """Return {time_constant, ambient, gain, steady_state} or None.
+
+        ambient and gain need samples with the heater off, steady_state
+        samples with it on; each is None until seen MODEL_MIN_STEPS times.
+        None as well if the fit is not finite.
+        """
+        theta0, theta1, loss = self.theta
+        if (not all(math.isfinite(v) for v in self.theta)
+                or loss <= 1e-6 or sum(self.steps) < MODEL_MIN_STEPS):
+            return None
+        fit = {"time_constant": 1. / loss, "ambient": None, "gain": None,
+               "steady_state": None}
+        if self.steps[0] >= MODEL_MIN_STEPS:
+            fit["ambient"] = theta0 / loss
+            fit["gain"] = theta1 / loss
+        if self.steps[1] >= MODEL_MIN_STEPS:
+            fit["steady_state"] = (theta0 + theta1) / loss
+        if not all(math.isfinite(v) for v in fit.values() if v is not None):
+            return None
+        return fit
+
+    def eta(self, temp, target, fit=None):
+        """Seconds to reach target from temp, heating when below it and
+        cooling with the heater off when above; None if the fit cannot
+        tell or the target lies beyond where the chamber settles."""
+        fit = fit or self.fit()
+        if fit is None:
+            return None
+        final = fit["steady_state"] if target > temp else fit["ambient"]
+        if final is None:
+            return None
+        if (final - target) * (target - temp) <= 0.:
+            return 0. if target == temp else None
+        eta = fit["time_constant"] * math.log(
+            (final - temp) / (final - target))
+        return eta if math.isfinite(eta) else None
+
+
+# ─── Shared I/O loop ──────────────────────────────────────────────────────────
+
+class _Resolver:
+    """Host name cache shared by every connection.
+
+    getaddrinfo() blocks, and mDNS names such as pandabreath.local can
+    take seconds or fail intermittently, so lookups run on a short-lived
+    thread and concurrent lookups of one name share it.  Answers are
+    cached for `ttl` seconds.  An expired entry is still answered at once
+    while a background lookup refreshes it, and a failed lookup falls
+    back to the last known-good addresses.  IP literals skip the cache.
+    """
+
+    def __init__(self, ttl=RESOLVE_TTL):
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        # (host, port) → [addrinfo list, expiry]
+        self._cache = {}
+        # (host, port) → [(loop, callback)] waiting for a lookup
+        self._pending = {}
+        self._hits = 0
+        self._misses = 0
+        self._refreshes = 0
+        self._lookups = 0
+        self._failures = 0
+        self._fallbacks = 0
+        self._lookup_time = 0.
+        self._lookup_time_max = 0.
+
+    def resolve(self, loop, host, port, callback):
+        """callback(addrinfo list, exc) runs on the loop thread."""
+        try:
+            infos = socket.getaddrinfo(host, port, socket.AF_UNSPEC,
+                                       socket.SOCK_STREAM, 0,
+                                       socket.AI_NUMERICHOST)
+        except socket.gaierror:
+            pass
+        else:
+            loop.call_soon(callback, infos, None)
+            return
+        key = (host, port)
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                self._misses += 1
+                waiters = self._pending.get(key)
+                if waiters is not None:
+                    waiters.append((loop, callback))
+                    return
+                self._pending[key] = [(loop, callback)]
+            else:
+                self._hits += 1
+                if (time.monotonic() < entry[1]
+                        or key in self._pending):
+                    loop.call_soon(callback, entry[0], None)
+                    return
+                self._refreshes += 1
+                self._pending[key] = []
+                loop.call_soon(callback, entry[0], None)
+        threading.Thread(target=self._lookup, args=(key,),
+                         name="panda_breath_dns", daemon=True).start()
+
+    def _lookup(self, key):
+        start = time.monotonic()
+        try:
+            infos = socket.getaddrinfo(key[0], key[1], socket.AF_UNSPEC,
+                                       socket.SOCK_STREAM)
+            exc = None
+        except Exception as err:
+            infos, exc = None, err
+        end = time.monotonic()
+        with self._lock:
+            self._lookups += 1
+            self._lookup_time += end - start
+            self._lookup_time_max = max(self._lookup_time_max, end - start)
+            entry = self._cache.get(key)
+            if exc is None:
+                self._cache[key] = [infos, end + self._ttl]
+            else:
+                self._failures += 1
+                if entry is not None:
+                    # Last known-good answer; retried on the next use
+                    self._fallbacks += 1
+                    infos, exc = entry[0], None
+            waiters = self._pending.pop(key, [])
+        if exc is not None:
+            logger.warning("panda_breath: cannot resolve %s: %s",
+                           key[0], exc)
+        for loop, callback in waiters:
+            loop.call_soon(callback, infos, exc)
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "dns_cache_hits": self._hits,
+                "dns_cache_misses": self._misses,
+                "dns_refreshes": self._refreshes,
+                "dns_lookups": self._lookups,
+                "dns_failures": self._failures,
+                "dns_fallbacks": self._fallbacks,
+                "dns_lookup_time_avg": (
+                    round(self._lookup_time / self._lookups, 4)
+                    if self._lookups else None),
+                "dns_lookup_time_max": round(self._lookup_time_max, 4),
+            }
+
+
+def _interleave_families(infos):
+    """Order addresses for racing: alternate families, first family first."""
+    families = collections.OrderedDict()
+    for info in infos:
+        families.setdefault(info[0], collections.deque()).append(info)
+    ordered = []
+    queues = list(families.values())
+    while queues:
+        for queue in queues:
+            ordered.append(queue.popleft())
+        queues = [queue for queue in queues if queue]
+    return ordered
+
+
+class _IoLoop:
+    """One selector thread that runs the network I/O of every transport.
+
+    Connections, reconnect delays, keepalives and retransmission deadlines
+    of all configured devices are driven from this thread, so the thread
+    count and the number of wake-ups do not grow with the device count.
+    Handlers and timers run on the loop thread and must never block.
+    Other threads hand work over with call_soon(), which wakes the
+    selector through a socketpair (one wake byte per burst); every other
+    method is for the loop thread only.
+
+    The loop is shared and reference counted: acquire() starts it on first
+    use and the last release() lets the thread exit.
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+    # Outlives the loop, so a Klipper restart keeps the cached addresses
+    resolver = _Resolver()
+
+    @classmethod
+    def acquire(cls):
+        with cls._instance_lock:
+            loop = cls._instance
+            if loop is None:
+                loop = cls._instance = cls()
+                loop._thread.start()
+            loop._refs += 1
+            return loop
+
+    def release(self):
+        with _IoLoop._instance_lock:
+            self._refs -= 1
+            if self._refs > 0:
+                return
+            if _IoLoop._instance is self:
+                _IoLoop._instance = None
+        self._running = False
+        self._wake()
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
+        self._lock = threading.Lock()
+        self._callbacks = collections.deque()
+        self._wake_pending = False
+        # Heap of [when, seq, callback, args]; cancel() clears the callback
+        self._timers = []
+        self._timer_seq = 0
+        self._refs = 0
+        self._running = True
+        self._ident = None
+        self._wakeups = 0
+        self._fds = 0
+        self._thread = threading.Thread(
+            target=self._run, name="panda_breath_io", daemon=True)
+
+    def call_soon(self, callback, *args):
+        """Run callback(*args) on the loop thread; safe from any thread."""
+        with self._lock:
+            self._callbacks.append((callback, args))
+            if self._wake_pending or threading.get_ident() == self._ident:
+                return
+            self._wake_pending = True
+        self._wake()
+
+    def call_at(self, when, callback, *args):
+        """Run callback(*args) at time.monotonic() `when`; returns a handle."""
+        self._timer_seq += 1
+        handle = [when, self._timer_seq, callback, args]
+        heapq.heappush(self._timers, handle)
+        return handle
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(time.monotonic() + delay, callback, *args)
+
+    @staticmethod
+    def cancel(handle):
+        if handle is not None:
+            handle[2] = None
+
+    def register(self, sock, events, handler):
+        """Call handler(mask) whenever sock is ready for events."""
+        self._selector.register(sock, events, handler)
+        self._fds += 1
+
+    def modify(self, sock, events, handler):
+        self._selector.modify(sock, events, handler)
+
+    def unregister(self, sock):
+        try:
+            self._selector.unregister(sock)
+        except (KeyError, ValueError):
+            return
+        self._fds -= 1
+
+    def resolve(self, host, port, callback):
+        """Look up host through the shared _Resolver cache.
+
+        callback(addrinfo list, exc) runs on the loop thread.
+        """
+        _IoLoop.resolver.resolve(self, host, port, callback)
+
+    def get_stats(self):
+        stats = {
+            "io_clients": self._refs,
+            "io_fds": self._fds,
+            "io_timers": len(self._timers),
+            "io_wakeups": self._wakeups,
+        }
+        stats.update(self.resolver.get_stats())
+        return stats
+
+    def _wake(self):
+        try:
+            self._wake_w.send(b"\0")
+        except OSError:
+            pass
+
+    def _timeout(self):
+        if self._callbacks:
+            return 0.
+        timers = self._timers
+        while timers and timers[0][2] is None:
+            heapq.heappop(timers)
+        if not timers:
+            return None
+        return max(0., timers[0][0] - time.monotonic())
+
+    def _call(self, callback, args):
+        try:
+            callback(*args)
+        except Exception:
+            logger.exception("panda_breath: I/O loop callback failed")
+
+    def _run(self):
+        self._ident = threading.get_ident()
+        while self._running:
+            events = self._selector.select(self._timeout())
+            self._wakeups += 1
+            for key, mask in events:
+                if key.fileobj is self._wake_r:
+                    try:
+                        while self._wake_r.recv(64):
+                            pass
+                    except OSError:
+                        pass
+                else:
+                    self._call(key.data, (mask,))
+            now = time.monotonic()
+            timers = self._timers
+            while timers and timers[0][0] <= now:
+                _, _, callback, args = heapq.heappop(timers)
+                if callback is not None:
+                    self._call(callback, args)
+            with self._lock:
+                callbacks = self._callbacks
+                self._callbacks = collections.deque()
+                self._wake_pending = False
+            for callback, args in callbacks:
+                self._call(callback, args)
+        self._selector.close()
+        self._wake_r.close()
+        self._wake_w.close()
+
+
+class _LoopConnection:
+    """Non-blocking TCP client connection driven by an _IoLoop.
+
+    open() resolves and connects without blocking the loop.  When the
+    name has several addresses they are raced Happy Eyeballs style: the
+    next address is tried CONNECT_RACE_DELAY after the previous one (or
+    as soon as it fails), families alternating, and the first to connect
+    wins.  Once the connection is up on_connect() runs, and incoming bytes are read into
+    `reader` (a _RecvBuffer) before on_data() parses them.  write() sends
+    what the socket accepts and keeps the rest until it becomes writable;
+    on_sent(ok) reports whether those bytes reached the kernel before the
+    connection closed, and on_drain() runs whenever the output buffer
+    empties.  An error, the connect timeout, or no incoming data for
+    idle_timeout seconds closes the connection, and on_close(exc) is
+    called exactly once (exc is None for an orderly close).
+    """
+
+    def __init__(self, loop, host, port, reader, on_connect, on_data,
+                 on_close, on_drain=None, connect_timeout=10.,
+                 idle_timeout=None):
+        self._loop = loop
+        self._host = host
+        self._port = port
+        self.reader = reader
+        self.on_connect = on_connect
+        self._on_data = on_data
+        self._on_close = on_close
+        self._on_drain = on_drain
+        self._connect_timeout = connect_timeout
+        self._idle_timeout = idle_timeout
+        self._sock = None
+        self._events = 0
+        self._timer = None
+        self._last_rx = 0.
+        # [pending bytes, on_sent] in write order
+        self._out = collections.deque()
+        # Address racing: addresses not tried yet, sockets still connecting
+        self._candidates = collections.deque()
+        self._attempts = []
+        self._race_timer = None
+        self._last_error = None
+        self._opened_at = None
+        # Seconds spent resolving, and from open() until connected
+        self.resolve_time = None
+        self.connect_time = None
+        self.connected = False
+        self.closed = False
+
+    @property
+    def idle(self):
+        """True when every written byte has been handed to the kernel."""
+        return not self._out
+
+    def open(self):
+        self._opened_at = time.monotonic()
+        self._timer = self._loop.call_later(
+            self._connect_timeout, self._check_timeout)
+        self._loop.resolve(self._host, self._port, self._resolved)
+
+    def write(self, data, on_sent=None):
+        if not self.connected or self.closed:
+            if on_sent is not None:
+                on_sent(False)
+            return False
+        self._out.append([memoryview(data), on_sent])
+        if len(self._out) == 1:
+            self._flush()
+        return True
+
+    def close(self, exc=None):
+        if self.closed:
+            return
+        self.closed = True
+        self._loop.cancel(self._timer)
+        self._loop.cancel(self._race_timer)
+        self._candidates.clear()
+        for attempt in self._attempts:
+            self._loop.unregister(attempt)
+            attempt.close()
+        del self._attempts[:]
+        sock, self._sock = self._sock, None
+        if sock is not None:
+            if self._events:
+                self._loop.unregister(sock)
+            try:
+                sock.close()
+            except Exception:
+                pass
+        out, self._out = self._out, collections.deque()
+        for _, on_sent in out:
+            if on_sent is not None:
+                on_sent(False)
+        self._on_close(exc)
+
+    def _resolved(self, infos, exc):
+        if self.closed:
+            return
+        if exc is not None:
+            self.close(exc)
+            return
+        self.resolve_time = time.monotonic() - self._opened_at
+        self._candidates.extend(_interleave_families(infos))
+        self._race()
+
+    def _race(self):
+        """Start connecting to the next address."""
+        self._race_timer = None
+        while self._candidates and not self.closed:
+            family, kind, proto, _, addr = self._candidates.popleft()
+            sock = None
+            try:
+                sock = socket.socket(family, kind, proto)
+                sock.setblocking(False)
+                err = sock.connect_ex(addr)
+                if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    raise OSError(err, os.strerror(err))
+            except Exception as exc:
+                self._last_error = exc
+                if sock is not None:
+                    sock.close()
+                continue
+            self._attempts.append(sock)
+            self._loop.register(sock, selectors.EVENT_WRITE,
+                                lambda mask, sock=sock: self._raced(sock))
+            if self._candidates:
+                self._race_timer = self._loop.call_later(
+                    CONNECT_RACE_DELAY, self._race)
+            return
+        if not self._attempts and not self.closed:
+            self.close(self._last_error
+                       or ConnectionError("no address for %s" % self._host))
+
+    def _raced(self, sock):
+        """One racing attempt finished connecting, or failed."""
+        if sock not in self._attempts:
+            return
+        self._attempts.remove(sock)
+        self._loop.unregister(sock)
+        err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            sock.close()
+            self._last_error = OSError(err, os.strerror(err))
+            # Do not wait out the race delay for the next address
+            self._loop.cancel(self._race_timer)
+            self._race()
+            return
+        self._loop.cancel(self._race_timer)
+        self._race_timer = None
+        self._candidates.clear()
+        for attempt in self._attempts:
+            self._loop.unregister(attempt)
+            attempt.close()
+        del self._attempts[:]
+        self._sock = sock
+        self.connected = True
+        now = time.monotonic()
+        self.connect_time = now - self._opened_at
+        self._last_rx = now
+        self._loop.cancel(self._timer)
+        self._timer = None
+        if self._idle_timeout:
+            self._timer = self._loop.call_later(
+                self._idle_timeout, self._check_timeout)
+        self._set_events(selectors.EVENT_READ)
+        try:
+            self.on_connect()
+        except Exception as exc:
+            self.close(exc)
+
+    def _set_events(self, events):
+        if events == self._events or self._sock is None:
+            return
+        if self._events:
+            self._loop.modify(self._sock, events, self._ready)
+        else:
+            self._loop.register(self._sock, events, self._ready)
+        self._events = events
+
+    def _check_timeout(self):
+        self._timer = None
+        if self.closed:
+            return
+        if not self.connected:
+            self.close(TimeoutError("connect timed out"))
+            return
+        deadline = self._last_rx + self._idle_timeout
+        if time.monotonic() >= deadline:
+            self.close(TimeoutError(
+                "no data for %.0fs" % self._idle_timeout))
+            return
+        self._timer = self._loop.call_at(deadline, self._check_timeout)
+
+    def _ready(self, mask):
+        sock = self._sock
+        if sock is None:
+            return
+        try:
+            if mask & selectors.EVENT_READ:
+                try:
+                    self.reader.fill(sock)
+                except (BlockingIOError, InterruptedError):
+                    pass
+                else:
+                    self._last_rx = time.monotonic()
+                    self._on_data()
+            if mask & selectors.EVENT_WRITE and not self.closed:
+                self._flush()
+        except Exception as exc:
+            self.close(exc)
+
+    def _flush(self):
+        while self._out:
+            entry = self._out[0]
+            try:
+                n = self._sock.send(entry[0])
+            except (BlockingIOError, InterruptedError):
+                n = 0
+            except Exception as exc:
+                # A partial write leaves the stream unusable
+                self.close(exc)
+                return
+            if n < len(entry[0]):
+                entry[0] = entry[0][n:]
+                self._set_events(
+                    selectors.EVENT_READ | selectors.EVENT_WRITE)
+                return
+            self._out.popleft()
+            if entry[1] is not None:
+                entry[1](True)
+            if self.closed:
+                return
+        self._set_events(selectors.EVENT_READ)
+        if self._on_drain is not None:
+            self._on_drain()
+
+
+# ─── Reconnect policy ─────────────────────────────────────────────────────────
+
+class _ReconnectPolicy:
+    """Decides how long a transport waits before reconnecting.
+
+    The first retry after a working connection drops is immediate, which
+    covers a single lost packet or a device-side reset.  Further consecutive
+    failures wait a random delay between 0 and min(cap, base * 2**n)
+    ("full jitter"), so many hosts reconnecting after a router reboot
+    spread out instead of hitting the ESP32 together.  A connection
+    that stays up for `stable` seconds resets the sequence; one that
+    drops sooner continues it.
+
+    Also keeps the attempt/failure counts, the time from losing a
+    connection to the next established one, and how much of the time to
+    connect went into name resolution.
+    """
+
+    def __init__(self, base=RECONNECT_BASE_DELAY, cap=RECONNECT_MAX_DELAY,
+                 stable=RECONNECT_STABLE):
+        self.base = base
+        self.cap = max(base, cap)
+        self.stable = stable
+        self._random = random.Random()
+        self._failures_in_row = 0
+        self._down_since = None
+        self._connected_at = None
+        self._attempts = 0
+        self._failures = 0
+        self._last_delay = None
+        self._times = collections.deque(maxlen=64)
+        self._resolve_time = None
+        self._connect_time = None
+        self._resolve_total = 0.
+        self._connect_total = 0.
+
+    def copy(self):
+        return _ReconnectPolicy(self.base, self.cap, self.stable)
+
+    def start(self, now):
+        """Count the initial connect as a reconnect from `now`."""
+        self._down_since = now
+        self._connected_at = None
+        self._failures_in_row = 0
+
+    def attempt(self):
+        self._attempts += 1
+
+    def connected(self, now, resolve_time=None, connect_time=None):
+        self._connected_at = now
+        if connect_time is not None:
+            self._resolve_time = resolve_time
+            self._connect_time = connect_time
+            self._resolve_total += resolve_time or 0.
+            self._connect_total += connect_time
+        if self._down_since is not None:
+            self._times.append(now - self._down_since)
+            self._down_since = None
+
+    def failed(self, now):
+        """Record a failed attempt or a dropped connection; returns the delay."""
+        self._failures += 1
+        if (self._connected_at is not None
+                and now - self._connected_at >= self.stable):
+            self._failures_in_row = 0
+        self._connected_at = None
+        if self._down_since is None:
+            self._down_since = now
+        if not self._failures_in_row:
+            delay = 0.
+        else:
+            delay = self._random.uniform(0., min(
+                self.cap, self.base * 2 ** (self._failures_in_row - 1)))
+        self._failures_in_row += 1
+        self._last_delay = delay
+        return delay
+
+    def get_stats(self):
+        times = sorted(self._times)
+        stats = {
+            "connect_attempts": self._attempts,
+            "connect_failures": self._failures,
+            "connects": len(times),
+            "reconnect_delay": (round(self._last_delay, 3)
+                                if self._last_delay is not None else None),
+            "reconnect_time_avg": None,
+            "reconnect_time_p50": None,
+            "reconnect_time_p95": None,
+            "resolve_time": (round(self._resolve_time, 4)
+                             if self._resolve_time is not None else None),
+            "connect_time": (round(self._connect_time, 4)
+                             if self._connect_time is not None else None),
+            "resolve_share": (round(self._resolve_total
+                                    / self._connect_total, 3)
+                              if self._connect_total > 0. else None),
+        }
+        if times:
+            stats["reconnect_time_avg"] = round(sum(times) / len(times), 3)
+            stats["reconnect_time_p50"] = round(
+                times[(len(times) - 1) // 2], 3)
+            stats["reconnect_time_p95"] = round(
+                times[min(len(times) - 1, int(len(times) * .95))], 3)
+        return stats
+
+
+# ─── Outbound writer ──────────────────────────────────────────────────────────
+
+class _OutboundWriter:
+    """Bounded send queue drained on the shared I/O loop.
+
+    put() is what the reactor thread calls: it appends to a deque under a
+    lock and schedules pump() on the loop, so a stalled device socket can
+    never block Klipper.  Entries carrying the same merge key replace each
+    other while still queued (a newer target supersedes a stale one); when
+    the queue is full the oldest entry is dropped.  pump() hands an entry
+    to send(item) only once ready() reports that the previous one has left
+    the transport's buffers, so entries keep merging while the link is
+    slow.  The transport calls pump() again whenever ready() may have
+    changed.
+    """
+
+    def __init__(self, name, send, ready, maxlen=SEND_QUEUE_SIZE):
+        self._name = name
+        self._send = send
+        self._ready = ready
+        self._maxlen = max(1, maxlen)
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._running = False
+        self._loop = None
+        self._scheduled = False
+        self._pumping = False
+        # time.monotonic() the entry in the transport was handed over
+        self._sending_since = None
+        self._queued = 0
+        self._sent = 0
+        self._merged = 0
+        self._dropped = 0
+        self._errors = 0
+        self._high_water = 0
+        self._max_wait = 0.
+        self._max_send = 0.
+
+    def start(self, loop):
+        with self._cond:
+            self._running = True
+            self._loop = loop
+            self._scheduled = True
+        loop.call_soon(self.pump)
+
+    def stop(self, flush=0.):
+        """Stop sending; with `flush`, first wait up to that many seconds
+        for queued entries (e.g. an emergency off) to go out."""
+        if flush:
+            self.flush(flush)
+        with self._cond:
+            self._running = False
+            self._queue.clear()
+            self._cond.notify_all()
+
+    def put(self, item, key=None):
+        with self._cond:
+            self._queued += 1
+            if key is not None:
+                for entry in self._queue:
+                    if entry[0] == key:
+                        self._queue.remove(entry)
+                        self._merged += 1
+                        break
+            if len(self._queue) >= self._maxlen:
+                self._queue.popleft()
+                self._dropped += 1
+            self._queue.append((key, item, time.monotonic()))
+            self._high_water = max(self._high_water, len(self._queue))
+            schedule = self._running and not self._scheduled
+            self._scheduled = self._scheduled or schedule
+        if schedule:
+            self._loop.call_soon(self.pump)
+
+    def discard(self, key):
+        """Drop still-unsent entries with the given merge key."""
+        with self._cond:
+            kept = [entry for entry in self._queue if entry[0] != key]
+            self._merged += len(self._queue) - len(kept)
+            self._queue = collections.deque(kept)
+
+    def flush(self, timeout):
+        """Wait up to timeout for every queued entry to be sent.
+
+        Only for paths that must not lose their last write (the emergency
+        off before stop()); returns False if the deadline passed first.
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._running and (
+                    self._queue or self._sending_since is not None):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0.:
+                    return False
+                self._cond.wait(remaining)
+            return not self._queue and self._sending_since is None
+
+    def get_stats(self):
+        with self._cond:
+            return {
+                "tx_queued": self._queued,
+                "tx_sent": self._sent,
+                "tx_merged": self._merged,
+                "tx_dropped": self._dropped,
+                "tx_errors": self._errors,
+                "tx_depth": len(self._queue),
+                "tx_high_water": self._high_water,
+                "tx_max_wait": round(self._max_wait, 4),
+                "tx_max_send": round(self._max_send, 4),
+            }
+
+    def pump(self):
+        """Loop thread: hand queued entries over while the transport is ready."""
+        if self._pumping:
+            return
+        self._pumping = True
+        try:
+            while True:
+                with self._cond:
+                    self._scheduled = False
+                    if not self._ready():
+                        return
+                    if self._sending_since is not None:
+                        self._max_send = max(
+                            self._max_send,
+                            time.monotonic() - self._sending_since)
+                        self._sending_since = None
+                        self._cond.notify_all()
+                    if not (self._running and self._queue):
+                        return
+                    _, item, queued_at = self._queue.popleft()
+                start = time.monotonic()
+                try:
+                    sent = self._send(item)
+                except Exception as exc:
+                    logger.warning("%s send error: %s", self._name, exc)
+                    sent = None
+                with self._cond:
+                    self._max_wait = max(self._max_wait, start - queued_at)
+                    if sent:
+                        self._sent += 1
+                        self._sending_since = start
+                    elif sent is None:
+                        self._errors += 1
+                    else:
+                        # Not connected; the reconnect replay restores state
+                        self._dropped += 1
+                    self._cond.notify_all()
+        finally:
+            self._pumping = False
+
+
+# ─── WebSocket transport (stock OEM firmware) ─────────────────────────────────
+
+class _SettingsBatch:
+    """Coalesces queued {"settings": ...} fields into as few frames as possible.
+
+    Fields queued inside one batch are merged into a single frame with
+    last-write-wins semantics.  A field listed in `barriers` closes the
+    current frame first, so firmware that cares about the order in which
+    fields arrive (v1.0.3 follows the web UI order) can still be served
+    in order.  A superseded value is removed from any earlier frame.
+    """
+
+    def __init__(self, barriers=()):
+        self._barriers = frozenset(barriers)
+        self.frames = []
+        self.queued = 0
+
+    def add(self, fields):
+        self.queued += 1
+        if (not self.frames
+                or (self.frames[-1] and self._barriers.intersection(fields))):
+            self.frames.append({})
+        current = self.frames[-1]
+        for key, value in fields.items():
+            for frame in self.frames[:-1]:
+                frame.pop(key, None)
+            current.pop(key, None)
+            current[key] = value
+
+    def take(self):
+        frames = [frame for frame in self.frames if frame]
+        queued = self.queued
+        self.frames = []
+        self.queued = 0
+        return frames, queued
+
+
+class _RecvBuffer:
+    """Reusable receive buffer shared by the stream decoders.
+
+    fill() reads whatever the socket has with a single recv_into() after
+    the unparsed data; subclasses parse complete units from
+    _buf[_start:_end] without further syscalls.  _need is the buffer end
+    the pending partial unit requires, so incomplete data is not re-parsed
+    on every fill().
+    """
+
+    _CLOSED = "connection closed"
+
+    def __init__(self, size):
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+        # Buffer end the pending partial unit needs before it can parse
+        self._need = 0
+
+    def feed(self, data):
+        """Append bytes that were read outside fill() (handshake leftovers)."""
+        self._reserve(len(data))
+        self._view[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def fill(self, sock):
+        if self._start == self._end:
+            self._start = self._end = 0
+        elif self._end == len(self._buf):
+            self._reserve(len(self._buf) // 2)
+        n = sock.recv_into(self._view[self._end:])
+        if not n:
+            raise ConnectionError(self._CLOSED)
+        self._end += n
+        return n
+
+    def take_until(self, delimiter):
+        """Consume and return the data up to and including delimiter.
+
+        Returns None while the delimiter has not arrived (HTTP headers in
+        front of the WebSocket stream).
+        """
+        index = self._buf.find(delimiter, self._start, self._end)
+        if index < 0:
+            return None
+        end = index + len(delimiter)
+        data = bytes(self._view[self._start:end])
+        self._start = end
+        return data
+
+    def _reserve(self, n):
+        """Make room for n more bytes after the unparsed data."""
+        pending = self._end - self._start
+        if self._start == self._end:
+            self._start = self._end = 0
+        if self._end + n <= len(self._buf):
+            return
+        size = len(self._buf)
+        while size < pending + n:
+            size *= 2
+        if size == len(self._buf) and self._start >= pending:
+            # Non-overlapping move of the partial unit to the front
+            self._buf[:pending] = self._view[self._start:self._end]
+        else:
+            # Fresh buffer: slices handed out earlier keep the old one alive
+            buf = bytearray(size)
+            buf[:pending] = self._view[self._start:self._end]
+            self._buf = buf
+            self._view = memoryview(buf)
+        if self._need:
+            self._need -= self._start
+        self._start = 0
+        self._end = pending
+
+
+class _WsFrameReader(_RecvBuffer):
+    """Incremental RFC 6455 frame parser over a reusable receive buffer.
+
+    fill() reads whatever the socket has with a single recv_into() into the
+    buffer; next_message() then parses as many complete frames as are
+    buffered without further syscalls.  Payloads are returned as memoryview
+    slices of the buffer and are only valid until the next call.
+    Fragmented messages (continuation opcode 0) are reassembled into one
+    payload; control frames may arrive between the fragments.
+    """
+
+    _CLOSED = "WS: connection closed"
+    _MAX_MESSAGE = 1 << 20
+
+    def __init__(self, size=65536):
+        _RecvBuffer.__init__(self, size)
+        self._fragments = None
+        self._fragment_opcode = 0
+
+    def _next_frame(self):
+        """Parse one buffered frame: (fin, opcode, payload) or None."""
+        if self._end < self._need:
+            return None
+        buf = self._buf
+        start = self._start
+        avail = self._end - start
+        if avail < 2:
+            return None
+        b1 = buf[start + 1]
+        length = b1 & 0x7F
+        offset = start + 2
+        if length == 126:
+            if avail < 4:
+                return None
+            length = (buf[offset] << 8) | buf[offset + 1]
+            offset += 2
+        elif length == 127:
+            if avail < 10:
+                return None
+            length = struct.unpack_from("!Q", buf, offset)[0]
+            offset += 8
+        if length > self._MAX_MESSAGE:
+            raise ConnectionError("WS: frame too large (%d bytes)" % length)
+        masked = b1 & 0x80
+        if masked:
+            offset += 4
+        if offset + length > self._end:
+            self._reserve(offset + length - self._end)
+            self._need = self._start + offset + length - start
+            return None
+        b0 = buf[start]
+        payload = self._view[offset:offset + length]
+        if masked:
+            payload = memoryview(_ws_mask(payload, buf[offset - 4:offset]))
+        self._start = offset + length
+        self._need = 0
+        return bool(b0 & 0x80), b0 & 0x0F, payload
 
-import collections
-import base64
-import hashlib
-import json
-import logging
-import os
-import socket
-import struct
-import threading
-import time
+    def next_message(self):
+        """Return (opcode, payload) for the next complete message, or None."""
+        while True:
+            frame = self._next_frame()
+            if frame is None:
+                return None
+            fin, opcode, payload = frame
+            if opcode & 0x8:
+                return opcode, payload
+            if opcode == 0x0:
+                if self._fragments is None:
+                    raise ConnectionError("WS: unexpected continuation frame")
+                self._fragments += payload
+                if len(self._fragments) > self._MAX_MESSAGE:
+                    raise ConnectionError("WS: fragmented message too large")
+                if not fin:
+                    continue
+                message = memoryview(self._fragments)
+                self._fragments = None
+                return self._fragment_opcode, message
+            if self._fragments is not None:
+                raise ConnectionError("WS: interleaved fragmented message")
+            if fin:
+                return opcode, payload
+            self._fragments = bytearray(payload)
+            self._fragment_opcode = opcode
 
-logger = logging.getLogger(__name__)
 
-# How long to wait between reconnect attempts (seconds)
-RECONNECT_DELAY = 5.
-# How often the Klipper reactor timer drains the state queue (seconds)
-REACTOR_POLL = 1.
-# Log a warning if no temperature update received within this window (seconds)
-TEMP_STALE_WARN = 60.
+class _MqttPacketReader(_RecvBuffer):
+    """Incremental MQTT 3.1.1 packet decoder over a reusable receive buffer.
 
+    next_packet() returns (type, flags, body) for each complete buffered
+    packet, or None when more data is needed; several packets from one
+    fill() are returned without further syscalls and a packet split across
+    reads is completed by later fills.  body is a memoryview slice of the
+    buffer, valid only until the next call.
+    """
 
-def _parse_bool(value):
-    """Return True/False for common JSON/HA values, or None if unknown."""
-    if isinstance(value, bool):
-        return value
-    if isinstance(value, (int, float)):
-        try:
-            return bool(int(value))
-        except Exception:
-            return None
-    if isinstance(value, str):
-        lowered = value.strip().lower()
-        if lowered in ("1", "true", "on", "yes"):
-            return True
-        if lowered in ("0", "false", "off", "no"):
-            return False
-    return None
+    _CLOSED = "MQTT: connection closed"
+    _MAX_PACKET = 1 << 20
 
+    def __init__(self, size=4096):
+        _RecvBuffer.__init__(self, size)
 
-# ─── WebSocket transport (stock OEM firmware) ─────────────────────────────────
+    def next_packet(self):
+        if self._end < self._need:
+            return None
+        buf = self._buf
+        start = self._start
+        end = self._end
+        # Remaining Length: 1-4 bytes, 7 bits each, least significant first
+        offset = start + 1
+        length = shift = 0
+        while True:
+            if offset >= end:
+                return None
+            byte = buf[offset]
+            offset += 1
+            length |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                break
+            shift += 7
+            if shift > 21:
+                raise ConnectionError("MQTT: malformed remaining length")
+        if length > self._MAX_PACKET:
+            raise ConnectionError("MQTT: packet too large (%d bytes)" % length)
+        if offset + length > end:
+            self._reserve(offset + length - end)
+            self._need = self._start + offset + length - start
+            return None
+        first = buf[start]
+        self._start = offset + length
+        self._need = 0
+        return first >> 4, first & 0x0F, self._view[offset:offset + length]
 
-class _WebSocketTransport:
-    """Minimal RFC 6455 WebSocket client for the Panda Breath OEM firmware.
 
-    Runs a background thread that maintains a persistent connection to
-    ws://<host>:<port>/ws, parses incoming JSON settings frames, and
-    invokes on_message({'temperature': float}) when a temperature field
-    is received.  Reconnects automatically on any error.
+class _SettingsCommands:
+    """Stock-firmware command sequences over {"settings": ...} fields.
 
-    Outbound commands use the {"settings": {...}} envelope the device expects.
-    The last-sent command is re-sent on every reconnect so the device is
-    always in the desired state after a connection drop.
+    Shared by the transports that talk to the OEM firmware.  Commands are
+    collected through a _SettingsBatch and queued on self._writer (provided
+    by the transport) as a list of settings dicts; the transport's writer
+    callback puts them on the wire.  The last command is remembered so
+    _resync() can restore it after a reconnect.
     """
 
-    def __init__(self, host, port, on_message, on_disconnect):
-        self._host = host
-        self._port = port
-        self._on_message = on_message
-        self._on_disconnect = on_disconnect
-        self._sock = None
-        self._running = False
-        self._thread = None
+    _OFF_SEQUENCE = (
+        {"isrunning": 0, "drying_running": False, "target_temp": 0},
+        {"work_on": False},
+    )
+
+    def _init_commands(self, barriers):
+        # Outbound settings batching; RLock so commands may nest
+        self._batch = _SettingsBatch(barriers)
+        self._batch_lock = threading.RLock()
+        self._batch_depth = 0
+        self._batch_key = None
+        self._frames_requested = 0
+        self._frames_batched = 0
+        self._frames_sent = 0
         # Last target degrees — resent on reconnect to keep device in sync
         self._last_target = 0.
         self._last_auto = None
         self._last_drying = None
 
-    def start(self):
-        self._running = True
-        self._thread = threading.Thread(
-            target=self._run, name="panda_breath_ws", daemon=True)
-        self._thread.start()
-
-    def stop(self):
-        self._running = False
-        sock = self._sock
-        if sock is not None:
-            try:
-                sock.close()
-            except Exception:
-                pass
-
     def set_target(self, degrees):
+        with self._batched("command"):
+            self._set_target(degrees)
+
+    def _set_target(self, degrees):
         self._last_target = degrees
         self._last_auto = None
         self._last_drying = None
@@ -142,6 +1806,10 @@ class _WebSocketTransport:
             self._send_settings({"work_on": False})
 
     def set_auto_mode(self, enabled, target_c, filtertemp_c, hotbedtemp_c):
+        with self._batched("command"):
+            self._set_auto_mode(enabled, target_c, filtertemp_c, hotbedtemp_c)
+
+    def _set_auto_mode(self, enabled, target_c, filtertemp_c, hotbedtemp_c):
         self._last_target = 0.
         self._last_auto = (
             bool(enabled),
@@ -164,6 +1832,10 @@ class _WebSocketTransport:
         self._send_settings({"work_on": bool(enabled)})
 
     def start_drying(self, temp_c, hours):
+        with self._batched("command"):
+            self._start_drying(temp_c, hours)
+
+    def _start_drying(self, temp_c, hours):
         self._last_auto = None
         self._last_drying = (int(temp_c), int(hours))
         self._send_settings({"work_mode": 3})
@@ -176,268 +1848,731 @@ class _WebSocketTransport:
 
     def stop_drying(self):
         self._last_drying = None
-        self._send_settings({"isrunning": 0, "drying_running": False})
-        self._send_settings({"work_on": False})
-
-    # ── internal ──────────────────────────────────────────────────────────────
+        with self._batched("command"):
+            self._send_settings({"isrunning": 0, "drying_running": False})
+            self._send_settings({"work_on": False})
 
-    def force_off(self):
+    def _forget_commands(self):
         self._last_target = 0.
         self._last_auto = None
         self._last_drying = None
-        off_sequence = (
-            {"isrunning": 0, "drying_running": False, "target_temp": 0},
-            {"work_on": False},
-        )
-        for fields in off_sequence:
-            self._send_settings(fields)
-        for fields in off_sequence:
-            self._send_settings_once(fields)
+
+    def _resync(self):
+        """Resend the desired state, e.g. after a reconnect."""
+        if self._last_drying is not None:
+            self.start_drying(*self._last_drying)
+        elif self._last_auto is not None and self._last_auto[0]:
+            self.set_auto_mode(*self._last_auto)
+        else:
+            self.set_target(self._last_target)
+
+    @contextlib.contextmanager
+    def _batched(self, key=None):
+        """Collect every _send_settings() call in the block into one batch.
+
+        The batch is queued for the writer under `key`, replacing any
+        still-unsent batch with the same key.
+        """
+        with self._batch_lock:
+            if not self._batch_depth:
+                self._batch_key = key
+            self._batch_depth += 1
+            try:
+                yield
+            finally:
+                self._batch_depth -= 1
+                if not self._batch_depth:
+                    self._flush_settings()
+
+    def _flush_settings(self):
+        frames, queued = self._batch.take()
+        self._frames_requested += queued
+        self._frames_batched += len(frames)
+        if frames:
+            self._writer.put(frames, key=self._batch_key)
+        self._batch_key = None
 
     def _send_settings(self, fields):
-        """Wrap fields in {"settings": fields} and send as a WebSocket text frame."""
-        self._ws_send(json.dumps({"settings": fields}))
+        """Queue fields for the {"settings": ...} frame of the current batch."""
+        with self._batch_lock:
+            self._batch.add(fields)
+            if not self._batch_depth:
+                self._flush_settings()
+
+
+class _WsConnection(_LoopConnection):
+    """_LoopConnection that performs the WebSocket upgrade and reads frames.
+
+    on_open() runs once the device has answered the upgrade.  Pings are
+    answered with a pong, data frames go to on_message(payload) (ignored
+    when None), and a close frame closes the connection without an error.
+    The device pings regularly, so 45 s without data closes it as dead.
+    """
+
+    def __init__(self, loop, host, port, on_open, on_message, on_close,
+                 on_drain=None, reader_size=65536, connect_timeout=10.):
+        _LoopConnection.__init__(
+            self, loop, host, port, _WsFrameReader(reader_size),
+            self._send_upgrade, self._receive, on_close, on_drain=on_drain,
+            connect_timeout=connect_timeout, idle_timeout=45.)
+        self.on_open = on_open
+        self._on_message = on_message
+        self.upgraded = False
+
+    def _send_upgrade(self):
+        """Send the HTTP/1.1 → WebSocket upgrade request."""
+        key = base64.b64encode(os.urandom(16)).decode()
+        request = (
+            "GET /ws HTTP/1.1\r\n"
+            "Host: {host}:{port}\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            "Sec-WebSocket-Key: {key}\r\n"
+            "Sec-WebSocket-Version: 13\r\n"
+            "\r\n"
+        ).format(host=self._host, port=self._port, key=key)
+        self.write(request.encode())
+
+    def _receive(self):
+        reader = self.reader
+        if not self.upgraded:
+            # Frames the device sends right behind the upgrade response
+            # stay buffered in the reader
+            head = reader.take_until(b"\r\n\r\n")
+            if head is None:
+                return
+            status_line = head.split(b"\r\n")[0]
+            if b"101" not in status_line:
+                raise ConnectionError(
+                    "WS handshake failed: %s"
+                    % status_line.decode(errors="replace"))
+            self.upgraded = True
+            self.on_open()
+        while not self.closed:
+            message = reader.next_message()
+            if message is None:
+                return
+            opcode, payload = message
+            if opcode == 0x8:   # close
+                self.close()
+            elif opcode == 0x9:  # ping → pong
+                self.write(struct.pack("!BB", 0x8A, len(payload)) + payload)
+            elif opcode in (0x1, 0x2) and self._on_message is not None:
+                self._on_message(payload)
+
+
+class _WebSocketTransport(_SettingsCommands):
+    """Minimal RFC 6455 WebSocket client for the Panda Breath OEM firmware.
+
+    Maintains a persistent connection to ws://<host>:<port>/ws on the
+    shared _IoLoop, parses incoming JSON settings frames, and invokes
+    on_message({'temperature': float}) when a temperature field is
+    received.  Reconnects automatically on any error.
+
+    Outbound commands use the {"settings": {...}} envelope the device expects.
+    Each command is queued through a _SettingsBatch so its fields leave as
+    one frame (or one frame per ordering barrier) instead of one per field.
+    Frames are written from an _OutboundWriter queue; a queued command that
+    has not gone out yet is replaced by a newer one.
+    The last-sent command is re-sent on every reconnect so the device is
+    always in the desired state after a connection drop.
+
+    force_off() bypasses the queue: the off frames are written on the main
+    connection and on a pre-warmed standby connection at once (or on a
+    one-shot connection if neither is up), and the caller waits at most
+    off_deadline seconds for the first write to complete.
+    """
+
+    def __init__(self, host, port, on_message, on_disconnect, barriers=(),
+                 send_queue_size=SEND_QUEUE_SIZE, standby=True,
+                 off_deadline=OFF_DEADLINE, reconnect=None,
+                 name="panda_breath"):
+        # Section name, prefixed to log lines to tell devices apart
+        self._name = name
+        self._host = host
+        self._port = port
+        self._on_message = on_message
+        self._on_disconnect = on_disconnect
+        self._loop = None
+        self._conn = None
+        self._running = False
+        self._reconnect = reconnect or _ReconnectPolicy()
+        self._reconnect_timer = None
+        # Second, idle connection kept warm for force_off()
+        self._standby_enabled = standby
+        self._standby = None
+        self._standby_reconnect = self._reconnect.copy()
+        self._standby_timer = None
+        self._off_deadline = off_deadline
+        self._off_lock = threading.Lock()
+        self._off_started = None
+        self._off_latency = None
+        self._off_confirm = None
+        self._off_paths = 0
+        self._off_tried = 0
+        self._off_pending = 0
+        self._off_ok = None
+        # Last work_on the device reported; off_confirm needs a true→false
+        self._device_work_on = None
+        self._writer = _OutboundWriter(
+            "%s WS writer" % name, self._write_frames, self._writer_ready,
+            send_queue_size)
+        self._init_commands(barriers)
+
+    def start(self):
+        self._running = True
+        self._reconnect.start(time.monotonic())
+        self._loop = _IoLoop.acquire()
+        self._writer.start(self._loop)
+        self._loop.call_soon(self._open_main)
+        if self._standby_enabled:
+            self._loop.call_soon(self._open_standby)
+
+    def stop(self):
+        if not self._running:
+            return
+        self._running = False
+        self._writer.stop()
+        self._loop.call_soon(self._shutdown, self._loop)
+
+    def get_stats(self):
+        standby = self._standby
+        stats = {
+            "frames_requested": self._frames_requested,
+            "frames_sent": self._frames_sent,
+            "frames_saved": self._frames_requested - self._frames_batched,
+            "standby_connected": standby is not None and standby.upgraded,
+            "off_ok": self._off_ok,
+            "off_latency": self._off_latency,
+            "off_confirm": self._off_confirm,
+            "off_paths": self._off_paths,
+        }
+        stats.update(self._reconnect.get_stats())
+        stats.update(self._writer.get_stats())
+        if self._loop is not None:
+            stats.update(self._loop.get_stats())
+        return stats
+
+    # ── internal ──────────────────────────────────────────────────────────────
 
-    def _send_settings_once(self, fields):
-        sock = None
+    def force_off(self):
+        self._forget_commands()
+        # Anything still queued is stale now; the off frames go out directly
+        self._writer.discard("command")
+        data = b"".join(self._encode_frame(json.dumps({"settings": fields}))
+                        for fields in self._OFF_SEQUENCE)
+        start = time.monotonic()
+        done = threading.Event()
+        with self._off_lock:
+            self._off_started = start
+            self._off_latency = None
+            self._off_confirm = None
+            self._off_paths = 0
+            self._off_tried = 0
+            self._off_pending = 0
+        # Own reference, so the off still goes out after stop()
+        loop = _IoLoop.acquire()
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(2.)
-            sock.connect((self._host, self._port))
-            self._handshake(sock)
-            self._send_frame(sock, json.dumps({"settings": fields}))
-        except Exception as exc:
-            logger.warning(
-                "panda_breath: one-shot WS send failed settings=%s: %s",
-                fields, exc)
+            loop.call_soon(self._send_off, loop, data, start, done)
+            done.wait(self._off_deadline)
         finally:
-            if sock is not None:
-                try:
-                    sock.close()
-                except Exception:
-                    pass
+            loop.release()
+        # Success is logged by _off_sent() once every path has finished
+        self._off_ok = self._off_latency is not None
+        if not self._off_ok:
+            logger.warning(
+                "%s: off not sent within %.2fs deadline "
+                "(%d paths tried)", self._name, self._off_deadline,
+                self._off_tried)
 
-    def _ws_send(self, text):
-        sock = self._sock
-        if sock is None:
+    def _send_off(self, loop, data, start, done):
+        """Loop thread: write the off frames on every open connection."""
+        paths = [conn for conn in (self._conn, self._standby)
+                 if conn is not None and conn.upgraded]
+        with self._off_lock:
+            if self._off_started != start:
+                return
+            self._off_tried = self._off_pending = len(paths) or 1
+        for conn in paths:
+            conn.write(data, lambda ok: self._off_sent(start, done, ok))
+        if paths:
             return
-        self._send_frame(sock, text)
+        # Neither connection is up: the off frames get a one-shot connection
+        conn = _WsConnection(
+            loop, self._host, self._port, None, None,
+            lambda exc: self._off_sent(start, done, False, exc),
+            reader_size=4096, connect_timeout=self._off_deadline)
+        conn.on_open = lambda: conn.write(
+            data, lambda ok: (self._off_sent(start, done, ok), conn.close()))
+        conn.open()
+
+    def _off_sent(self, start, done, ok, exc=None):
+        with self._off_lock:
+            if self._off_started != start or not self._off_pending:
+                return
+            self._off_pending -= 1
+            if ok:
+                self._off_paths += 1
+                if self._off_latency is None:
+                    self._off_latency = round(time.monotonic() - start, 4)
+            elif not self._off_pending and not self._off_paths:
+                # Every path failed; no point holding the reactor
+                done.set()
+            # Logged once the last path finished, with the stats' counts
+            report = None
+            if not self._off_pending and self._off_paths:
+                report = (self._off_latency, self._off_paths,
+                          self._off_tried)
+        if report is not None:
+            logger.info("%s: off sent in %.3fs (%d/%d paths)", self._name,
+                        *report)
+        if ok:
+            done.set()
+        else:
+            logger.warning("%s: off send failed: %s", self._name,
+                           exc or "connection closed")
+
+    def _write_frames(self, frames):
+        """Loop thread: encode queued settings frames and send in one write."""
+        conn = self._conn
+        if conn is None or not conn.upgraded:
+            return False
+        data = b"".join(self._encode_frame(json.dumps({"settings": fields}))
+                        for fields in frames)
+        if not conn.write(data):
+            return False
+        self._frames_sent += len(frames)
+        return True
 
-    def _send_frame(self, sock, text):
+    def _writer_ready(self):
+        conn = self._conn
+        return conn is None or conn.idle
+
+    @staticmethod
+    def _encode_frame(text):
         payload = text.encode("utf-8")
         length = len(payload)
         mask = os.urandom(4)
-        masked = bytes(b ^ mask[i & 3] for i, b in enumerate(payload))
+        masked = _ws_mask(payload, mask)
         if length < 126:
             header = struct.pack("!BB", 0x81, 0x80 | length)
         elif length < 65536:
             header = struct.pack("!BBH", 0x81, 0xFE, length)
         else:
             header = struct.pack("!BBQ", 0x81, 0xFF, length)
-        try:
-            sock.sendall(header + mask + masked)
-        except Exception as exc:
-            logger.warning("panda_breath: WS send error: %s", exc)
+        return header + mask + masked
 
-    def _handshake(self, sock):
-        """Perform the HTTP/1.1 → WebSocket upgrade handshake."""
-        key = base64.b64encode(os.urandom(16)).decode()
-        request = (
-            "GET /ws HTTP/1.1\r\n"
-            "Host: {host}:{port}\r\n"
-            "Upgrade: websocket\r\n"
-            "Connection: Upgrade\r\n"
-            "Sec-WebSocket-Key: {key}\r\n"
-            "Sec-WebSocket-Version: 13\r\n"
-            "\r\n"
-        ).format(host=self._host, port=self._port, key=key)
-        sock.sendall(request.encode())
-        # Read until end of HTTP headers
-        buf = b""
-        while b"\r\n\r\n" not in buf:
-            chunk = sock.recv(1024)
-            if not chunk:
-                raise ConnectionError("WS handshake: connection closed")
-            buf += chunk
-        status_line = buf.split(b"\r\n")[0]
-        if b"101" not in status_line:
-            raise ConnectionError(
-                "WS handshake failed: %s" % status_line.decode(errors="replace"))
-
-    def _recv_exact(self, sock, n):
-        buf = bytearray()
-        while len(buf) < n:
-            chunk = sock.recv(n - len(buf))
-            if not chunk:
-                raise ConnectionError("WS: connection closed mid-frame")
-            buf.extend(chunk)
-        return bytes(buf)
-
-    def _recv_frame(self, sock):
-        """Read one WebSocket frame. Returns (opcode, payload_bytes).
-        Handles multi-fragment messages by reassembling (rare in practice here).
-        """
-        header = self._recv_exact(sock, 2)
-        # FIN bit and opcode
-        opcode = header[0] & 0x0F
-        masked = bool(header[1] & 0x80)
-        length = header[1] & 0x7F
-        if length == 126:
-            length = struct.unpack("!H", self._recv_exact(sock, 2))[0]
-        elif length == 127:
-            length = struct.unpack("!Q", self._recv_exact(sock, 8))[0]
-        mask_key = self._recv_exact(sock, 4) if masked else None
-        payload = self._recv_exact(sock, length)
-        if masked:
-            payload = bytes(b ^ mask_key[i & 3] for i, b in enumerate(payload))
-        return opcode, payload
+    def _open_main(self):
+        self._reconnect_timer = None
+        if not self._running:
+            return
+        self._reconnect.attempt()
+        self._conn = _WsConnection(
+            self._loop, self._host, self._port, self._main_opened,
+            self._dispatch, self._main_closed, on_drain=self._writer.pump)
+        self._conn.open()
 
-    def _run(self):
-        """Background I/O thread: connect, receive, reconnect on any failure."""
-        while self._running:
-            sock = None
-            try:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.settimeout(10.)
-                sock.connect((self._host, self._port))
-                self._handshake(sock)
-                sock.settimeout(45.)  # device sends pings; 45 s gives headroom
-                self._sock = sock
-                logger.info("panda_breath: WebSocket connected to %s:%s",
-                            self._host, self._port)
-                # Resend desired state so device is in sync after reconnect
-                if self._last_drying is not None:
-                    self.start_drying(*self._last_drying)
-                elif self._last_auto is not None and self._last_auto[0]:
-                    self.set_auto_mode(*self._last_auto)
-                else:
-                    self.set_target(self._last_target)
-                while self._running:
-                    opcode, payload = self._recv_frame(sock)
-                    if opcode == 0x8:   # close
-                        break
-                    elif opcode == 0x9:  # ping → pong
-                        pong = struct.pack("!BB", 0x8A, len(payload)) + payload
-                        sock.sendall(pong)
-                    elif opcode in (0x1, 0x2):  # text or binary
-                        self._dispatch(payload)
-            except Exception as exc:
-                if self._running:
-                    logger.warning(
-                        "panda_breath: WS error (%s) — reconnect in %.0fs",
-                        exc, RECONNECT_DELAY)
-                    self._on_disconnect()
-            finally:
-                self._sock = None
-                if sock is not None:
-                    try:
-                        sock.close()
-                    except Exception:
-                        pass
-            if self._running:
-                time.sleep(RECONNECT_DELAY)
+    def _main_opened(self):
+        conn = self._conn
+        self._reconnect.connected(time.monotonic(), conn.resolve_time,
+                                  conn.connect_time)
+        logger.info("%s: WebSocket connected to %s:%s",
+                    self._name, self._host, self._port)
+        # Resend desired state so device is in sync after reconnect
+        self._resync()
+
+    def _main_closed(self, exc):
+        self._conn = None
+        # Unsent frames died with the socket; release the writer
+        self._writer.pump()
+        if not self._running:
+            return
+        delay = self._reconnect.failed(time.monotonic())
+        if exc is not None:
+            logger.warning(
+                "%s: WS error (%s) — reconnect in %.1fs",
+                self._name, exc, delay)
+            self._on_disconnect()
+        self._reconnect_timer = self._loop.call_later(
+            delay, self._open_main)
+
+    def _open_standby(self):
+        """Keep the standby connection open; its state pushes are ignored."""
+        self._standby_timer = None
+        if not self._running:
+            return
+        self._standby = _WsConnection(
+            self._loop, self._host, self._port, self._standby_opened, None,
+            self._standby_closed, reader_size=4096)
+        self._standby.open()
+
+    def _standby_opened(self):
+        self._standby_reconnect.connected(time.monotonic())
+
+    def _standby_closed(self, exc):
+        self._standby = None
+        if not self._running:
+            return
+        if exc is not None:
+            logger.debug("%s: WS standby error (%s)", self._name, exc)
+        self._standby_timer = self._loop.call_later(
+            self._standby_reconnect.failed(time.monotonic()),
+            self._open_standby)
+
+    def _shutdown(self, loop):
+        """Loop thread: close both connections and drop pending retries."""
+        loop.cancel(self._reconnect_timer)
+        loop.cancel(self._standby_timer)
+        self._reconnect_timer = self._standby_timer = None
+        for conn in (self._conn, self._standby):
+            if conn is not None:
+                conn.close()
+        loop.release()
+
+    def _note_off_confirmed(self):
+        """Loop thread: the device switched work_on from true to false.
+
+        Only counts once the off frames have been written, so a state push
+        already in flight (or a device that was off anyway) does not pass
+        for a confirmation.
+        """
+        with self._off_lock:
+            if (self._off_started is None or self._off_latency is None
+                    or self._off_confirm is not None):
+                return
+            self._off_confirm = round(time.monotonic() - self._off_started, 4)
+        logger.info("%s: device confirmed off after %.3fs",
+                    self._name, self._off_confirm)
 
     def _dispatch(self, payload):
         """Parse a JSON frame and push normalised state to the callback."""
         try:
-            msg = json.loads(payload.decode("utf-8"))
+            msg = json.loads(str(payload, "utf-8"))
         except Exception as exc:
-            logger.debug("panda_breath: WS parse error: %s", exc)
+            logger.debug("%s: WS parse error: %s", self._name, exc)
             return
         settings = msg.get("settings")
         if not isinstance(settings, dict):
             return
-        state = {}
-        # Prefer the ADC-calibrated reading; fall back to v1.0.4 and raw aliases.
-        for temp_key in ("cal_warehouse_temp", "chamber_temp",
-                         "warehouse_temper"):
-            if temp_key not in settings:
-                continue
-            try:
-                state["temperature"] = float(settings.get(temp_key))
-                break
-            except (TypeError, ValueError):
-                continue
-        for key in ("work_mode", "set_temp", "remaining_seconds", "isrunning",
-                    "filament_drying_mode", "target_temp", "heater_temp",
-                    "filament_button"):
-            if key in settings:
-                state[key] = settings.get(key)
-        if "temp" in settings:
-            state["auto_target"] = settings.get("temp")
-        if "filtertemp" in settings:
-            state["auto_filtertemp"] = settings.get("filtertemp")
-        elif "filter_temp" in settings:
-            state["auto_filtertemp"] = settings.get("filter_temp")
-        if "hotbedtemp" in settings:
-            state["auto_hotbedtemp"] = settings.get("hotbedtemp")
-        if "filament_temp" in settings:
-            state["filament_temp"] = settings.get("filament_temp")
-        elif "custom_temp" in settings:
-            state["filament_temp"] = settings.get("custom_temp")
-        if "filament_timer" in settings:
-            state["filament_timer"] = settings.get("filament_timer")
-        elif "custom_timer" in settings:
-            state["filament_timer"] = settings.get("custom_timer")
-        if "drying_remaining_min" in settings:
-            state["drying_remaining_min"] = settings.get("drying_remaining_min")
-        if "drying_running" in settings:
-            parsed = _parse_bool(settings.get("drying_running"))
-            if parsed is not None:
-                state["drying_running"] = parsed
-        if "work_on" in settings:
-            parsed = _parse_bool(settings.get("work_on"))
-            if parsed is not None:
-                state["work_on"] = parsed
+        state = _decode_settings(settings)
+        work_on = state.get("work_on")
+        if work_on is not None:
+            if work_on is False and self._device_work_on:
+                self._note_off_confirmed()
+            self._device_work_on = work_on
         if state:
             self._on_message(state)
 
 
 # ─── MQTT transport (ESPHome firmware) ────────────────────────────────────────
 
+class _TopicTrie:
+    """Topic → handler routing compiled once from MQTT topic filters.
+
+    Filters are stored level by level in nested dicts, so match() costs one
+    dict lookup per topic level on the raw topic bytes.  An exact level is
+    preferred over '+' (one level) and '#' (all remaining levels).
+    """
+
+    def __init__(self, routes=()):
+        self._root = {}
+        self.filters = []
+        for topic_filter, handler in routes:
+            self.add(topic_filter, handler)
+
+    def add(self, topic_filter, handler):
+        node = self._root
+        for level in topic_filter.encode("utf-8").split(b"/"):
+            node = node.setdefault(level, {})
+        node[None] = handler
+        self.filters.append(topic_filter)
+
+    def match(self, topic):
+        """Return the handler for topic (bytes), or None."""
+        return self._match(self._root, topic.split(b"/"), 0)
+
+    def _match(self, node, levels, index):
+        if index == len(levels):
+            handler = node.get(None)
+            if handler is None and b"#" in node:
+                # 'a/#' also matches the parent level 'a'
+                handler = node[b"#"].get(None)
+            return handler
+        child = node.get(levels[index])
+        if child is not None:
+            handler = self._match(child, levels, index + 1)
+            if handler is not None:
+                return handler
+        child = node.get(b"+")
+        if child is not None:
+            handler = self._match(child, levels, index + 1)
+            if handler is not None:
+                return handler
+        child = node.get(b"#")
+        if child is not None:
+            return child.get(None)
+        return None
+
+
+def _esphome_field(field, convert):
+    def decode(payload):
+        return {field: convert(payload)}
+    return decode
+
+
+def _esphome_mode(payload):
+    # The ESPHome climate only heats or is off; heat maps to always-on
+    mode = payload.lower()
+    if mode == "off":
+        return {"work_on": False}
+    return {"work_mode": 2, "work_on": True}
+
+
+# ESPHome state topics (under the topic prefix) → payload decoder returning
+# the same state fields the stock transport fills
+_ESPHOME_TOPICS = (
+    ("sensor/chamber_temperature/state", _esphome_field("temperature", float)),
+    ("sensor/ptc_element_temperature/state",
+     _esphome_field("heater_temp", float)),
+    ("climate/chamber/mode/state", _esphome_mode),
+    ("climate/chamber/target_temperature/state",
+     _esphome_field("set_temp", float)),
+    ("fan/fan/state", _esphome_field("fan_on", _to_bool)),
+    ("fan/fan/speed_level/state", _esphome_field("fan_speed", int)),
+)
+
+
+class _InflightWindow:
+    """QoS 1 publishes awaiting PUBACK, bounded to a fixed window.
+
+    acquire() allocates a packet id and records the publish, or returns
+    None while the window is full; the transport then holds the publish
+    back, and newer publishes to the same topic merge in the
+    _OutboundWriter queue meanwhile.  A publish that is sent supersedes
+    the one still in flight for its topic, which is then no longer
+    retransmitted (latest value wins).  A PUBACK releases the slot and
+    records per-topic ack latency, and due() returns the publishes whose
+    retry timeout expired for a DUP retransmission.  Everything runs on
+    the I/O loop; the lock only guards get_stats() from the reactor.
+    """
+
+    def __init__(self, size=MQTT_INFLIGHT, retry_timeout=MQTT_RETRY_TIMEOUT):
+        self._size = max(1, size)
+        self._retry_timeout = retry_timeout
+        self._lock = threading.Lock()
+        # packet id → [topic, message, first_sent, last_sent, superseded,
+        #              group]
+        self._inflight = collections.OrderedDict()
+        self._next_id = 0
+        self._open = False
+        self._acked = 0
+        self._retransmits = 0
+        self._superseded = 0
+        self._expired = 0
+        # topic → [acks, last latency, max latency, total latency]
+        self._latency = {}
+
+    def open(self):
+        with self._lock:
+            self._open = True
+
+    def close(self, discard=True):
+        """Stop issuing packet ids until the next open()."""
+        with self._lock:
+            self._open = False
+            if discard:
+                self._inflight.clear()
+
+    def acquire(self, topic, message, group=None):
+        """Return a packet id for the publish, or None if full or closed.
+
+        Publishes sharing a non-None group (the frames of one command)
+        do not supersede each other.
+        """
+        with self._lock:
+            if not self._open or len(self._inflight) >= self._size:
+                return None
+            for entry in self._inflight.values():
+                if (entry[0] == topic and not entry[4]
+                        and (group is None or entry[5] is not group)):
+                    entry[4] = True
+                    self._superseded += 1
+            packet_id = self._next_id
+            while True:
+                packet_id = packet_id % 0xFFFF + 1
+                if packet_id not in self._inflight:
+                    break
+            self._next_id = packet_id
+            now = time.monotonic()
+            self._inflight[packet_id] = [topic, message, now, now, False,
+                                         group]
+            return packet_id
+
+    def ack(self, packet_id):
+        with self._lock:
+            entry = self._inflight.pop(packet_id, None)
+            if entry is None:
+                return
+            self._acked += 1
+            latency = time.monotonic() - entry[2]
+            stats = self._latency.get(entry[0])
+            if stats is None:
+                stats = self._latency[entry[0]] = [0, 0., 0., 0.]
+            stats[0] += 1
+            stats[1] = latency
+            stats[2] = max(stats[2], latency)
+            stats[3] += latency
+
+    def resume(self, now):
+        """Publishes to resend on a resumed session, in send order."""
+        resend = []
+        with self._lock:
+            for packet_id, entry in self._inflight.items():
+                if not entry[4]:
+                    entry[3] = now
+                    self._retransmits += 1
+                    resend.append((packet_id, entry[0], entry[1]))
+        return resend
+
+    def due(self, now):
+        """Publishes to retransmit now; superseded ones are released."""
+        resend = []
+        with self._lock:
+            for packet_id, entry in list(self._inflight.items()):
+                if now - entry[3] < self._retry_timeout:
+                    continue
+                if entry[4]:
+                    del self._inflight[packet_id]
+                    self._expired += 1
+                    continue
+                entry[3] = now
+                self._retransmits += 1
+                resend.append((packet_id, entry[0], entry[1]))
+        return resend
+
+    def next_deadline(self):
+        with self._lock:
+            if not self._inflight:
+                return None
+            return (min(entry[3] for entry in self._inflight.values())
+                    + self._retry_timeout)
+
+    def get_stats(self, strip=""):
+        with self._lock:
+            latency = {}
+            for topic, (count, last, peak, total) in self._latency.items():
+                if topic.startswith(strip):
+                    topic = topic[len(strip):]
+                latency[topic] = {
+                    "acks": count,
+                    "last": round(last, 4),
+                    "max": round(peak, 4),
+                    "avg": round(total / count, 4),
+                }
+            return {
+                "inflight": len(self._inflight),
+                "pubacks": self._acked,
+                "retransmits": self._retransmits,
+                "superseded": self._superseded,
+                "superseded_expired": self._expired,
+                "ack_latency": latency,
+            }
+
+
 class _MqttTransport:
     """Minimal MQTT 3.1.1 client for the ESPHome Panda Breath firmware.
 
     Implements only the packet types needed:
-      Send:    CONNECT, SUBSCRIBE, PUBLISH (QoS 0), PINGREQ, DISCONNECT
-      Receive: CONNACK, SUBACK, PUBLISH (QoS 0), PINGRESP
+      Send:    CONNECT, SUBSCRIBE, PUBLISH (QoS 0/1), PINGREQ, DISCONNECT
+      Receive: CONNACK, SUBACK, PUBLISH (QoS 0), PUBACK, PINGRESP
 
-    Subscribes to {prefix}/sensor/chamber_temperature/state and calls
-    on_message({'temperature': float}) on each retained/incoming value.
+    Subscribes to every topic in _ESPHOME_TOPICS with a single SUBSCRIBE
+    and routes incoming PUBLISHes through a _TopicTrie compiled for the
+    configured prefix, calling on_message() with the decoded state fields.
 
-    set_target() publishes to climate mode/target topics.
-    The last command is re-published on every reconnect.
-    """
+    set_target() publishes to climate mode/target topics through an
+    _OutboundWriter; a queued publish is replaced by a newer one to the
+    same topic.  With qos=1 commands are tracked in an _InflightWindow
+    until the broker acknowledges them.  The last command is re-published
+    on every reconnect.
 
-    _PING_INTERVAL = 30.
+    The connection runs on the shared _IoLoop.  A timer sends PINGREQ
+    every keepalive/2 regardless of traffic, and a PINGRESP missing for
+    ping_timeout seconds drops the connection and reconnects.
+    """
 
-    def __init__(self, broker, port, topic_prefix, on_message, on_disconnect):
+    def __init__(self, broker, port, topic_prefix, on_message, on_disconnect,
+                 send_queue_size=SEND_QUEUE_SIZE, keepalive=MQTT_KEEPALIVE,
+                 ping_timeout=None, qos=1, inflight=MQTT_INFLIGHT,
+                 retry_timeout=MQTT_RETRY_TIMEOUT, client_id=MQTT_CLIENT_ID,
+                 clean_session=True, reconnect=None, name="panda_breath"):
+        # Section name, prefixed to log lines to tell devices apart
+        self._name = name
         self._broker = broker
         self._port = port
         self._prefix = topic_prefix
         self._on_message = on_message
         self._on_disconnect = on_disconnect
-        self._sock = None
+        self._loop = None
+        self._conn = None
         self._running = False
-        self._thread = None
+        # Packet type expected next during CONNECT/SUBSCRIBE, then None
+        self._expect = None
+        self._session_present = False
+        self._reconnect = reconnect or _ReconnectPolicy()
+        self._reconnect_timer = None
         self._last_target = 0.
+        self._publishes_sent = 0
+        # (topic, message, group) waiting for an in-flight window slot
+        self._pending = collections.deque()
+        self._keepalive = keepalive
+        self._ping_interval = keepalive / 2.
+        if ping_timeout is None:
+            ping_timeout = keepalive / 5.
+        self._ping_timeout = ping_timeout
+        self._ping_timer = None
+        self._next_ping = 0.
+        self._ping_sent = None
+        self._pings_sent = 0
+        self._ping_timeouts = 0
+        self._broker_rtt = None
+        self._broker_rtt_max = 0.
+        self._topics = _TopicTrie(self._routes())
+        self._unrouted = 0
+        self._qos = qos
+        self._window = _InflightWindow(inflight, retry_timeout)
+        self._retry_timer = None
+        self._client_id = client_id
+        self._clean_session = clean_session
+        self._session_resumed = 0
+        self._retained_received = 0
+        # Time to the first temperature, from start() and per connection
+        self._started_at = None
+        self._connect_started = None
+        self._startup_latency = None
+        self._first_value_latency = None
+        self._first_value_retained = None
+        self._writer = _OutboundWriter(
+            "%s MQTT writer" % name, self._write_item, self._writer_ready,
+            send_queue_size)
 
     def start(self):
         self._running = True
-        self._thread = threading.Thread(
-            target=self._run, name="panda_breath_mqtt", daemon=True)
-        self._thread.start()
+        self._started_at = time.monotonic()
+        self._startup_latency = None
+        self._reconnect.start(self._started_at)
+        self._loop = _IoLoop.acquire()
+        self._writer.start(self._loop)
+        self._loop.call_soon(self._connect)
 
     def stop(self):
+        if not self._running:
+            return
         self._running = False
-        sock = self._sock
-        if sock is not None:
-            try:
-                # Best-effort DISCONNECT
-                sock.sendall(b"\xe0\x00")
-                sock.close()
-            except Exception:
-                pass
+        # The off publish queued by force_off() must not be cleared unsent
+        self._writer.stop(flush=OFF_DEADLINE)
+        self._window.close()
+        self._loop.call_soon(self._shutdown, self._loop)
 
     def set_target(self, degrees):
         self._last_target = degrees
@@ -454,6 +2589,39 @@ class _MqttTransport:
     def force_off(self):
         self._last_target = 0.
         self._publish("%s/climate/chamber/mode/set" % self._prefix, "off")
+        # On shutdown nothing calls stop(), so flush here as well
+        self._writer.flush(OFF_DEADLINE)
+
+    def _resync(self):
+        """Resend the desired state after a reconnect."""
+        self.set_target(self._last_target)
+
+    def _routes(self):
+        """(topic filter, payload decoder) pairs to subscribe and route."""
+        return [("%s/%s" % (self._prefix, topic), decode)
+                for topic, decode in _ESPHOME_TOPICS]
+
+    def get_stats(self):
+        stats = {
+            "publishes_sent": self._publishes_sent,
+            "pings_sent": self._pings_sent,
+            "ping_timeouts": self._ping_timeouts,
+            "broker_rtt": self._broker_rtt,
+            "broker_rtt_max": self._broker_rtt_max,
+            "unrouted_publishes": self._unrouted,
+            "retained_received": self._retained_received,
+            "sessions_resumed": self._session_resumed,
+            "startup_first_value": self._startup_latency,
+            "first_value_latency": self._first_value_latency,
+            "first_value_retained": self._first_value_retained,
+        }
+        stats.update(self._reconnect.get_stats())
+        if self._qos:
+            stats.update(self._window.get_stats(strip=self._prefix + "/"))
+        stats.update(self._writer.get_stats())
+        if self._loop is not None:
+            stats.update(self._loop.get_stats())
+        return stats
 
     # ── MQTT packet helpers ───────────────────────────────────────────────────
 
@@ -476,9 +2644,9 @@ class _MqttTransport:
         encoded = s.encode("utf-8")
         return struct.pack("!H", len(encoded)) + encoded
 
-    def _build_connect(self, client_id="panda_breath_klipper",
-                       keepalive=60, username=None, password=None):
-        flags = 0x02  # clean session
+    def _build_connect(self, client_id=MQTT_CLIENT_ID, keepalive=60,
+                       username=None, password=None, clean_session=True):
+        flags = 0x02 if clean_session else 0x00
         if username:
             flags |= 0x80
         if password:
@@ -495,130 +2663,246 @@ class _MqttTransport:
         body = vh + payload
         return b"\x10" + self._encode_remaining_length(len(body)) + body
 
-    def _build_subscribe(self, topic, packet_id=1):
-        payload = struct.pack("!H", packet_id) + self._mqtt_str(topic) + b"\x00"
+    def _build_subscribe(self, topics, packet_id=1):
+        payload = struct.pack("!H", packet_id) + b"".join(
+            self._mqtt_str(topic) + b"\x00" for topic in topics)
         return b"\x82" + self._encode_remaining_length(len(payload)) + payload
 
-    def _build_publish(self, topic, message):
-        # QoS 0, no retain, no DUP
+    def _build_publish(self, topic, message, packet_id=None, dup=False):
+        # QoS 0 without a packet id, QoS 1 with one; never retained
+        first = 0x30
         vh = self._mqtt_str(topic)
+        if packet_id is not None:
+            first |= 0x02
+            if dup:
+                first |= 0x08
+            vh += struct.pack("!H", packet_id)
         body = vh + message.encode("utf-8")
-        return b"\x30" + self._encode_remaining_length(len(body)) + body
+        return (bytes([first]) + self._encode_remaining_length(len(body))
+                + body)
 
     @staticmethod
     def _build_pingreq():
         return b"\xc0\x00"
 
-    # ── socket receive helpers ────────────────────────────────────────────────
-
-    def _recv_exact(self, sock, n):
-        buf = bytearray()
-        while len(buf) < n:
-            chunk = sock.recv(n - len(buf))
-            if not chunk:
-                raise ConnectionError("MQTT: connection closed")
-            buf.extend(chunk)
-        return bytes(buf)
-
-    def _recv_remaining_length(self, sock):
-        multiplier, value = 1, 0
-        for _ in range(4):
-            byte = ord(self._recv_exact(sock, 1))
-            value += (byte & 0x7F) * multiplier
-            multiplier <<= 7
-            if not (byte & 0x80):
-                break
-        return value
+    # ── publish helper (usable from reactor thread too) ───────────────────────
+
+    def _publish(self, topic, message):
+        self._writer.put((topic, message), key=topic)
+
+    def _write_publish(self, item):
+        """Loop thread: queue one PUBLISH from the writer for sending."""
+        if self._conn is None or self._expect is not None:
+            return False
+        self._pending.append((item[0], item[1], None))
+        self._send_pending()
+        return True
+
+    # Writer callback; transports queuing other items override it
+    _write_item = _write_publish
+
+    def _writer_ready(self):
+        conn = self._conn
+        return (conn is None or self._expect is not None
+                or (not self._pending and conn.idle))
+
+    def _send_pending(self):
+        """Loop thread: send held-back publishes while the window has room."""
+        conn = self._conn
+        while self._pending and conn is not None and self._expect is None:
+            topic, message, group = self._pending[0]
+            if self._qos:
+                packet_id = self._window.acquire(topic, message, group)
+                if packet_id is None:
+                    # Window full; the next PUBACK or expiry resumes
+                    return
+                pkt = self._build_publish(topic, message, packet_id)
+            else:
+                pkt = self._build_publish(topic, message)
+            self._pending.popleft()
+            conn.write(pkt)
+            self._publishes_sent += 1
+            self._published(group)
+            if self._qos and self._retry_timer is None:
+                self._arm_retry()
+        self._writer.pump()
+
+    def _published(self, group):
+        """Hook called for every PUBLISH put on the wire."""
+
+    def _arm_retry(self):
+        self._loop.cancel(self._retry_timer)
+        deadline = self._window.next_deadline()
+        self._retry_timer = None
+        if deadline is not None:
+            self._retry_timer = self._loop.call_at(deadline, self._retransmit)
+
+    def _retransmit(self):
+        """Loop thread: resend expired QoS 1 publishes with the DUP flag."""
+        self._retry_timer = None
+        conn = self._conn
+        if conn is None or self._expect is not None:
+            return
+        for packet_id, topic, message in self._window.due(time.monotonic()):
+            conn.write(self._build_publish(topic, message, packet_id,
+                                           dup=True))
+        self._arm_retry()
+        # Expired superseded entries may have freed window slots
+        self._send_pending()
+
+    # ── connection on the I/O loop ────────────────────────────────────────────
+
+    def _connect(self):
+        self._reconnect_timer = None
+        if not self._running:
+            return
+        self._reconnect.attempt()
+        self._conn = _LoopConnection(
+            self._loop, self._broker, self._port, _MqttPacketReader(),
+            self._connected, self._receive, self._closed,
+            on_drain=self._writer.pump)
+        self._conn.open()
 
-    def _recv_packet(self, sock):
-        """Read one MQTT packet. Returns (packet_type_nibble, flags_nibble, body_bytes)."""
-        first = ord(self._recv_exact(sock, 1))
-        ptype = (first >> 4) & 0xF
-        pflags = first & 0xF
-        remaining = self._recv_remaining_length(sock)
-        body = self._recv_exact(sock, remaining) if remaining else b""
-        return ptype, pflags, body
+    def _connected(self):
+        self._connect_started = time.monotonic()
+        self._first_value_latency = None
+        # CONNECT and SUBSCRIBE leave in one write, so the broker's
+        # retained state arrives one round trip after connecting
+        self._expect = 2
+        self._conn.write(
+            self._build_connect(
+                self._client_id, int(self._keepalive),
+                clean_session=self._clean_session)
+            + self._build_subscribe(self._topics.filters, packet_id=1))
 
-    # ── publish helper (usable from reactor thread too) ───────────────────────
+    def _receive(self):
+        """Loop thread: handle every complete packet in the buffer."""
+        conn = self._conn
+        reader = conn.reader
+        while not conn.closed:
+            packet = reader.next_packet()
+            if packet is None:
+                return
+            ptype, pflags, body = packet
+            if self._expect is not None:
+                self._handshake(ptype, body)
+            elif ptype == 3:     # PUBLISH
+                self._dispatch_publish(pflags, body)
+            elif ptype == 4 and len(body) >= 2:  # PUBACK
+                self._window.ack((body[0] << 8) | body[1])
+                self._send_pending()
+            elif ptype == 13 and self._ping_sent is not None:  # PINGRESP
+                rtt = time.monotonic() - self._ping_sent
+                self._broker_rtt = rtt
+                self._broker_rtt_max = max(self._broker_rtt_max, rtt)
+                self._ping_sent = None
+                self._loop.cancel(self._ping_timer)
+                self._ping_timer = self._loop.call_at(
+                    self._next_ping, self._keepalive_tick)
 
-    def _publish(self, topic, message):
-        sock = self._sock
-        if sock is None:
+    def _handshake(self, ptype, body):
+        if self._expect == 2:
+            if ptype != 2:
+                raise ConnectionError(
+                    "MQTT: expected CONNACK (2), got %d" % ptype)
+            if len(body) >= 2 and body[1] != 0:
+                raise ConnectionError(
+                    "MQTT: CONNACK refused, code=%d" % body[1])
+            self._session_present = bool(len(body) >= 1 and body[0] & 0x01)
+            self._expect = 9
             return
-        pkt = self._build_publish(topic, message)
-        try:
-            sock.sendall(pkt)
-        except Exception as exc:
-            logger.warning("panda_breath: MQTT publish error: %s", exc)
+        if ptype != 9:
+            raise ConnectionError(
+                "MQTT: expected SUBACK (9), got %d" % ptype)
+        refused = [topic for topic, code in zip(self._topics.filters,
+                                                body[2:]) if code == 0x80]
+        if refused:
+            logger.warning("%s: MQTT broker refused subscription to %s",
+                           self._name, ", ".join(refused))
+        self._expect = None
+        session_present = self._session_present
+        if not session_present:
+            # The broker has no record of unacknowledged ids
+            self._window.close()
+        self._window.open()
+        now = time.monotonic()
+        if session_present:
+            # Resumed session: resend unacknowledged commands
+            self._session_resumed += 1
+            for packet_id, topic, message in self._window.resume(now):
+                self._conn.write(self._build_publish(
+                    topic, message, packet_id, dup=True))
+            self._arm_retry()
+        self._reconnect.connected(now, self._conn.resolve_time,
+                                  self._conn.connect_time)
+        logger.info("%s: MQTT connected to %s:%s%s",
+                    self._name, self._broker, self._port,
+                    " (session resumed)" if session_present else "")
+        self._next_ping = now + self._ping_interval
+        self._ping_sent = None
+        self._ping_timer = self._loop.call_at(
+            self._next_ping, self._keepalive_tick)
+        # Resend desired state after reconnect
+        self._resync()
 
-    # ── background thread ─────────────────────────────────────────────────────
+    def _keepalive_tick(self):
+        """Loop thread: send PINGREQ on schedule, drop a silent broker."""
+        self._ping_timer = None
+        conn = self._conn
+        if conn is None or self._expect is not None:
+            return
+        now = time.monotonic()
+        if self._ping_sent is not None:
+            deadline = self._ping_sent + self._ping_timeout
+            if now >= deadline:
+                self._ping_timeouts += 1
+                conn.close(ConnectionError(
+                    "MQTT: no PINGRESP within %.1fs" % self._ping_timeout))
+                return
+        elif now >= self._next_ping:
+            conn.write(self._build_pingreq())
+            self._pings_sent += 1
+            self._ping_sent = now
+            self._next_ping += self._ping_interval
+            if self._next_ping <= now:
+                self._next_ping = now + self._ping_interval
+            deadline = now + self._ping_timeout
+        else:
+            deadline = self._next_ping
+        self._ping_timer = self._loop.call_at(deadline, self._keepalive_tick)
 
-    def _run(self):
-        while self._running:
-            sock = None
-            try:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.settimeout(10.)
-                sock.connect((self._broker, self._port))
-                sock.sendall(self._build_connect())
-                # Expect CONNACK (type 2)
-                ptype, _, body = self._recv_packet(sock)
-                if ptype != 2:
-                    raise ConnectionError(
-                        "MQTT: expected CONNACK (2), got %d" % ptype)
-                if len(body) >= 2 and body[1] != 0:
-                    raise ConnectionError(
-                        "MQTT: CONNACK refused, code=%d" % body[1])
-                # Subscribe to chamber temperature topic
-                temp_topic = "%s/sensor/chamber_temperature/state" % self._prefix
-                sock.sendall(self._build_subscribe(temp_topic, packet_id=1))
-                # Expect SUBACK (type 9)
-                ptype, _, _ = self._recv_packet(sock)
-                if ptype != 9:
-                    raise ConnectionError(
-                        "MQTT: expected SUBACK (9), got %d" % ptype)
-                sock.settimeout(self._PING_INTERVAL + 5.)
-                self._sock = sock
-                logger.info("panda_breath: MQTT connected to %s:%s",
-                            self._broker, self._port)
-                # Resend desired state after reconnect
-                self.set_target(self._last_target)
-                last_ping = time.monotonic()
-                while self._running:
-                    # Send PINGREQ on schedule
-                    now = time.monotonic()
-                    if now - last_ping >= self._PING_INTERVAL:
-                        sock.sendall(self._build_pingreq())
-                        last_ping = now
-                    try:
-                        ptype, pflags, body = self._recv_packet(sock)
-                    except socket.timeout:
-                        # Use timeout to drive ping; not a fatal error
-                        continue
-                    if ptype == 3:   # PUBLISH
-                        self._dispatch_publish(pflags, body)
-                    elif ptype == 13:  # PINGRESP — nothing to do
-                        pass
-                    elif ptype == 0:   # malformed / connection close
-                        break
-            except Exception as exc:
-                if self._running:
-                    logger.warning(
-                        "panda_breath: MQTT error (%s) — reconnect in %.0fs",
-                        exc, RECONNECT_DELAY)
-                    self._on_disconnect()
-            finally:
-                self._sock = None
-                if sock is not None:
-                    try:
-                        sock.close()
-                    except Exception:
-                        pass
-            if self._running:
-                time.sleep(RECONNECT_DELAY)
+    def _closed(self, exc):
+        self._conn = None
+        self._expect = None
+        for timer in (self._ping_timer, self._retry_timer):
+            self._loop.cancel(timer)
+        self._ping_timer = self._retry_timer = None
+        # Held-back publishes are restored by the reconnect replay
+        self._pending.clear()
+        # A persistent session keeps unacknowledged ids for resending
+        self._window.close(discard=self._clean_session)
+        self._writer.pump()
+        if not self._running:
+            return
+        delay = self._reconnect.failed(time.monotonic())
+        logger.warning(
+            "%s: MQTT error (%s) — reconnect in %.1fs",
+            self._name, exc, delay)
+        self._on_disconnect()
+        self._reconnect_timer = self._loop.call_later(delay, self._connect)
+
+    def _shutdown(self, loop):
+        """Loop thread: best-effort DISCONNECT, then close."""
+        loop.cancel(self._reconnect_timer)
+        self._reconnect_timer = None
+        conn = self._conn
+        if conn is not None:
+            conn.write(b"\xe0\x00")
+            conn.close()
+        loop.release()
 
     def _dispatch_publish(self, flags, body):
-        """Parse an incoming PUBLISH packet and call on_message if it's our topic."""
+        """Route an incoming PUBLISH through the topic trie to on_message."""
         # QoS is bits 2-1 of flags; QoS 0 has no packet ID
         qos = (flags >> 1) & 0x3
         offset = 0
@@ -628,16 +2912,131 @@ class _MqttTransport:
         offset += 2
         if offset + topic_len > len(body):
             return
-        topic = body[offset:offset + topic_len].decode("utf-8", errors="replace")
+        decode = self._topics.match(bytes(body[offset:offset + topic_len]))
+        if decode is None:
+            self._unrouted += 1
+            return
         offset += topic_len
         if qos > 0:
             offset += 2  # skip packet ID (not used for QoS 0 publishes we send)
-        payload = body[offset:].decode("utf-8", errors="replace").strip()
-        if topic.endswith("/chamber_temperature/state"):
-            try:
-                self._on_message({"temperature": float(payload)})
-            except (TypeError, ValueError):
-                pass
+        payload = str(body[offset:], "utf-8", "replace").strip()
+        try:
+            state = decode(payload)
+        except (TypeError, ValueError):
+            return
+        if not state:
+            return
+        retained = bool(flags & 0x01)
+        if retained:
+            self._retained_received += 1
+        if "temperature" in state and self._first_value_latency is None:
+            now = time.monotonic()
+            self._first_value_latency = round(now - self._connect_started, 4)
+            self._first_value_retained = retained
+            if self._startup_latency is None:
+                self._startup_latency = round(now - self._started_at, 4)
+        self._on_message(state)
+
+
+# ─── MQTT transport (stock firmware v1.0.4+) ──────────────────────────────────
+
+class _StockMqttTransport(_SettingsCommands, _MqttTransport):
+    """MQTT client for the native btt_mqtt client of stock firmware 1.0.4+.
+
+    The device publishes its state as JSON to {prefix}/{device_id}/state
+    and takes JSON commands on {prefix}/{device_id}/command, both in the
+    shape of the WebSocket {"settings": ...} body, so state is decoded
+    with _decode_settings() and commands reuse the _SettingsCommands
+    sequences (one publish per settings frame).  Boolean switch fields
+    (work_on, drying_running) are sent as the documented "ON"/"OFF"
+    strings.  The HA `mode` entity is not mapped: its values are not
+    documented, so modes are set and read through work_mode only.
+    {prefix}/{device_id}/availability is the device's LWT: "offline"
+    marks it disconnected.
+
+    Connection handling, keepalive and QoS 1 delivery are inherited from
+    _MqttTransport.  Unlike the WebSocket transport, every Klipper host
+    and dashboard shares the broker's fan-out instead of holding its own
+    connection to the ESP32.
+    """
+
+    def __init__(self, broker, port, topic_prefix, device_id, on_message,
+                 on_disconnect, barriers=(), **kwargs):
+        base = "%s/%s" % (topic_prefix, device_id)
+        self._state_topic = base + "/state"
+        self._command_topic = base + "/command"
+        self._availability_topic = base + "/availability"
+        self._device_available = None
+        self._init_commands(barriers)
+        _MqttTransport.__init__(self, broker, port, topic_prefix, on_message,
+                                on_disconnect, **kwargs)
+
+    def force_off(self):
+        self._forget_commands()
+        # Stale queued commands are dropped; the off frames take their slot
+        self._writer.discard("command")
+        self._frames_requested += len(self._OFF_SEQUENCE)
+        self._frames_batched += len(self._OFF_SEQUENCE)
+        self._writer.put(list(self._OFF_SEQUENCE), key="command")
+        # On shutdown nothing calls stop(), so flush here as well
+        self._writer.flush(OFF_DEADLINE)
+
+    def get_stats(self):
+        stats = _MqttTransport.get_stats(self)
+        stats.update({
+            "frames_requested": self._frames_requested,
+            "frames_sent": self._frames_sent,
+            "frames_saved": self._frames_requested - self._frames_batched,
+            "device_available": self._device_available,
+        })
+        return stats
+
+    def _routes(self):
+        return [(self._state_topic, self._decode_state),
+                (self._availability_topic, self._decode_availability)]
+
+    @staticmethod
+    def _decode_state(payload):
+        msg = json.loads(payload)
+        if not isinstance(msg, dict):
+            return None
+        settings = msg.get("settings", msg)
+        if not isinstance(settings, dict):
+            return None
+        return _decode_settings(settings)
+
+    def _decode_availability(self, payload):
+        available = payload.lower() == "online"
+        if self._device_available is not False and not available:
+            logger.warning("%s: device reported offline via MQTT",
+                           self._name)
+            self._on_disconnect()
+        self._device_available = available
+        # Connected state returns with the next state publish
+        return None
+
+    def _write_item(self, frames):
+        """Loop thread: queue each settings frame as one publish, in order."""
+        if self._conn is None or self._expect is not None:
+            return False
+        # A newer command supersedes the unacknowledged frames of older
+        # ones, but the frames of one command never supersede each other
+        for fields in frames:
+            self._pending.append(
+                (self._command_topic, self._encode_command(fields), frames))
+        self._send_pending()
+        return True
+
+    @staticmethod
+    def _encode_command(fields):
+        return json.dumps({
+            key: ("ON" if value else "OFF") if isinstance(value, bool)
+            else value
+            for key, value in fields.items()})
+
+    def _published(self, group):
+        if group is not None:
+            self._frames_sent += 1
 
 
 # ─── Klipper heater class ──────────────────────────────────────────────────────
@@ -649,70 +3048,163 @@ class PandaBreath:
     can define a standard [heater_generic] in their config.
     """
 
+    temperature = _StateAttr()
+    target = _StateAttr()
+    smoothed_temp = _StateAttr()
+    is_connected = _StateAttr("connected")
+    work_mode = _StateAttr()
+    work_on = _StateAttr()
+    device_target = _StateAttr()
+    heater_temp = _StateAttr()
+    auto_enabled = _StateAttr()
+    auto_target = _StateAttr()
+    auto_filtertemp = _StateAttr()
+    auto_hotbedtemp = _StateAttr()
+    filament_temp = _StateAttr()
+    filament_timer = _StateAttr()
+    remaining_seconds = _StateAttr()
+    drying_remaining_min = _StateAttr()
+    filament_button = _StateAttr()
+    filament_drying_active = _StateAttr()
+    fan_on = _StateAttr()
+    fan_speed = _StateAttr()
+    temperature_slope = _StateAttr()
+
     def __init__(self, config):
         self.printer = config.get_printer()
         self.reactor = self.printer.get_reactor()
-        self.name = config.get_name().split()[-1]
+        # [panda_breath NAME] sections get their own chip, sensor type and
+        # default heater name, "panda_breath_NAME"
+        parts = config.get_name().split(None, 1)
+        self.device = parts[1].strip() if len(parts) > 1 else None
+        self.name = ("panda_breath_%s" % self.device if self.device
+                     else "panda_breath")
 
         # Config
         firmware = config.get("firmware", "stock")
-        self.host = config.get("host")
+        # Device address (WebSocket transport only)
+        self.host = config.get("host", None)
         self.port = config.getint("port", 80)
+        # Fields that must start a new settings frame (empty = one frame)
+        settings_barriers = config.getlist(
+            "settings_barriers", SETTINGS_BARRIERS)
 
-        # state — modified by reactor poll
-        self.temperature = 0.
-        self.target = 0.
-        self.smoothed_temp = 0.
-        self.is_connected = False
-        self.work_mode = 2
-        self.work_on = False
-        self.device_target = 0.
-        self.heater_temp = 0.
-        self.auto_enabled = False
-        self.auto_target = 45
-        self.auto_filtertemp = 30
-        self.auto_hotbedtemp = 80
-        self.filament_temp = 0
-        self.filament_timer = 0
-        self.remaining_seconds = 0
-        self.drying_remaining_min = 0
-        self.filament_button = 0
-        self.filament_drying_active = False
+        # state — modified by reactor poll, read through the _StateAttr
+        # attributes below
+        self.state = _DeviceState()
+        # get_status() fields built at _status_version, and the snapshot
+        # served with the sample age as of the latest poll
+        self._status_fields = None
+        self._status_version = None
+        self._status = None
+        self._status_age = None
         self._in_shutdown = False
         self._external_off_lockout = False
+        # Reactor time at which the latest temperature sample was received
         self._last_temp_time = 0.
+        self._sample_mono = 0.
+        self._new_sample = False
+        self._last_read_time = 0.
+        self._next_stale_warn = 0.
+        self._held_reports = 0
+        # Report period advertised to Klipper's heater; the optional
+        # estimate is diagnostic only (sample_period in get_status)
+        self.report_period = config.getfloat("report_period", 1., above=0.)
+        self._estimate_period = config.getboolean(
+            "estimate_sample_period", False)
+        self._history = _History(
+            config.getint("history_size", HISTORY_SIZE, minval=1))
+        self._smoother = _TempSmoother(config)
+        self._model = _ThermalModel()
+        self._wait_tolerance = config.getfloat(
+            "wait_tolerance", WAIT_TOLERANCE, minval=0.)
+        # Receipt time of a sample applied this poll, not yet recorded
+        self._history_time = None
+        self._sample_period = None
+        # time.monotonic() → reactor clock mapping, refreshed every poll
+        self._clock_offset = 0.
+        self._clock_ref = None
+        self._clock_drift_ppm = 0.
         self._sensor = None
         self._virtual_pin = None
+        # Objects resolved once by _bind_objects(); hot paths use the cache
         self._heater = None
+        self._pin_owner = None
+        self._mcu = None
+        self._pheaters = None
+        self._toolhead = None
+        self._bound = False
+        self._next_bind = 0.
+        self._object_lookups = 0
         self._heater_set_temp_orig = None
 
-        # Thread-safe queue for background I/O
-        self._state_queue = collections.deque()
+        # Thread-safe latest-value hand-off from background I/O
+        self._state_store = _StateStore()
+        # The I/O thread wakes the reactor through an async callback; the flag
+        # coalesces a burst of frames into a single wake-up
+        self._wake_pending = False
+        self._poll_active = False
+        self._last_poll = 0.
+        self._poll_interval = config.getfloat(
+            "poll_interval", REACTOR_POLL, above=0., maxval=4.)
+        self._min_poll_interval = config.getfloat(
+            "min_poll_interval", REACTOR_MIN_POLL, minval=0.,
+            maxval=self._poll_interval)
+        self._idle_poll_interval = config.getfloat(
+            "idle_poll_interval", REACTOR_IDLE_POLL,
+            minval=self._poll_interval, maxval=4.)
 
         # Transport initialization
+        send_queue_size = config.getint(
+            "send_queue_size", SEND_QUEUE_SIZE, minval=1)
+        reconnect_base = config.getfloat(
+            "reconnect_base_delay", RECONNECT_BASE_DELAY, above=0.)
+        reconnect = _ReconnectPolicy(
+            reconnect_base,
+            config.getfloat("reconnect_max_delay", RECONNECT_MAX_DELAY,
+                            minval=reconnect_base),
+            config.getfloat("reconnect_stable_time", RECONNECT_STABLE,
+                            minval=0.))
         if firmware == "stock":
+            self.host = config.get("host")
             self._transport = _WebSocketTransport(
-                self.host, self.port, self._enqueue, self._on_disconnect)
+                self.host, self.port, self._enqueue, self._on_disconnect,
+                barriers=settings_barriers, send_queue_size=send_queue_size,
+                standby=config.getboolean("standby_connection", True),
+                off_deadline=config.getfloat(
+                    "off_deadline", OFF_DEADLINE, above=0., maxval=10.),
+                reconnect=reconnect, name=self.name)
         elif firmware == "esphome":
-            broker = config.get("mqtt_broker")
-            mqtt_port = config.getint("mqtt_port", 1883)
-            prefix = config.get("mqtt_topic_prefix", "panda-breath")
             self._transport = _MqttTransport(
-                broker, mqtt_port, prefix, self._enqueue, self._on_disconnect)
+                config.get("mqtt_broker"), config.getint("mqtt_port", 1883),
+                config.get("mqtt_topic_prefix", "panda-breath"),
+                self._enqueue, self._on_disconnect,
+                send_queue_size=send_queue_size, reconnect=reconnect,
+                name=self.name, **self._mqtt_options(config, self.device))
+        elif firmware == "stock_mqtt":
+            self._transport = _StockMqttTransport(
+                config.get("mqtt_broker"), config.getint("mqtt_port", 1883),
+                config.get("mqtt_topic_prefix"), config.get("mqtt_device_id"),
+                self._enqueue, self._on_disconnect,
+                barriers=settings_barriers, send_queue_size=send_queue_size,
+                reconnect=reconnect, name=self.name,
+                **self._mqtt_options(config, self.device))
         else:
             raise config.error("panda_breath: unknown firmware '%s'" % firmware)
 
         # 1. Register sensor factory so user can use: sensor_type: panda_breath
         pheaters = self.printer.load_object(config, 'heaters')
-        pheaters.add_sensor_factory("panda_breath", self._create_sensor)
+        pheaters.add_sensor_factory(self.name, self._create_sensor)
 
         # 2. Register virtual chip so user can use: heater_pin: panda_breath:pwm
         ppins = self.printer.lookup_object('pins')
-        ppins.register_chip('panda_breath', self)
+        ppins.register_chip(self.name, self)
 
         # Klipper lifecycle
         self.printer.register_event_handler(
             "klippy:connect", self._handle_connect)
+        self.printer.register_event_handler(
+            "klippy:ready", self._handle_ready)
         self.printer.register_event_handler(
             "klippy:disconnect", self._handle_disconnect)
         self.printer.register_event_handler(
@@ -721,10 +3213,56 @@ class PandaBreath:
         self._poll_timer = self.reactor.register_timer(
             self._reactor_poll, self.reactor.NEVER)
 
+        # DEVICE=NAME selects a [panda_breath NAME]; without it the
+        # commands address the unnamed [panda_breath]
         gcode = self.printer.lookup_object('gcode')
-        gcode.register_command('PANDA_BREATH_AUTO', self._cmd_panda_breath_auto)
-        gcode.register_command('PANDA_BREATH_DRY_START', self._cmd_panda_breath_dry_start)
-        gcode.register_command('PANDA_BREATH_DRY_STOP', self._cmd_panda_breath_dry_stop)
+        gcode.register_mux_command(
+            'PANDA_BREATH_AUTO', 'DEVICE', self.device,
+            self._cmd_panda_breath_auto, desc=self.cmd_PANDA_BREATH_AUTO_help)
+        gcode.register_mux_command(
+            'PANDA_BREATH_DRY_START', 'DEVICE', self.device,
+            self._cmd_panda_breath_dry_start,
+            desc=self.cmd_PANDA_BREATH_DRY_START_help)
+        gcode.register_mux_command(
+            'PANDA_BREATH_DRY_STOP', 'DEVICE', self.device,
+            self._cmd_panda_breath_dry_stop,
+            desc=self.cmd_PANDA_BREATH_DRY_STOP_help)
+        gcode.register_mux_command(
+            'PANDA_BREATH_HISTORY', 'DEVICE', self.device,
+            self._cmd_panda_breath_history,
+            desc=self.cmd_PANDA_BREATH_HISTORY_help)
+        gcode.register_mux_command(
+            'PANDA_BREATH_ETA', 'DEVICE', self.device,
+            self._cmd_panda_breath_eta,
+            desc=self.cmd_PANDA_BREATH_ETA_help)
+        gcode.register_mux_command(
+            'PANDA_BREATH_WAIT', 'DEVICE', self.device,
+            self._cmd_panda_breath_wait,
+            desc=self.cmd_PANDA_BREATH_WAIT_help)
+        PandaBreathGroup.lookup(self.printer).add(self)
+
+    @staticmethod
+    def _mqtt_options(config, device=None):
+        """Options shared by the MQTT transports."""
+        keepalive = config.getfloat(
+            "mqtt_keepalive", MQTT_KEEPALIVE, minval=2., maxval=65535.)
+        return {
+            "keepalive": keepalive,
+            "ping_timeout": config.getfloat(
+                "mqtt_ping_timeout", keepalive / 5., above=0.,
+                maxval=keepalive / 2.),
+            "qos": config.getint("mqtt_qos", 1, minval=0, maxval=1),
+            "inflight": config.getint(
+                "mqtt_inflight", MQTT_INFLIGHT, minval=1, maxval=64),
+            "retry_timeout": config.getfloat(
+                "mqtt_retry_timeout", MQTT_RETRY_TIMEOUT, above=0.),
+            # Client ids must be unique per broker connection
+            "client_id": config.get(
+                "mqtt_client_id", "%s_%s" % (MQTT_CLIENT_ID, device)
+                if device else MQTT_CLIENT_ID),
+            "clean_session": not config.getboolean(
+                "mqtt_persistent_session", False),
+        }
 
     def _create_sensor(self, config):
         self._sensor = PandaBreathSensor(config, self)
@@ -741,17 +3279,26 @@ class PandaBreath:
 
     def _handle_connect(self):
         self._in_shutdown = False
+        self._bind_objects()
         self._attach_heater_hook()
         self._transport.start()
+        self._poll_active = True
         self.reactor.update_timer(self._poll_timer, self.reactor.NOW)
         self._force_device_off("connect")
 
+    def _handle_ready(self):
+        if not self._bound:
+            self._bind_objects()
+            self._attach_heater_hook()
+
     def _handle_disconnect(self):
         self._in_shutdown = True
         self._force_device_off("disconnect")
         self._transport.stop()
+        self._poll_active = False
         self.reactor.update_timer(self._poll_timer, self.reactor.NEVER)
-        
+        self._invalidate_binding()
+
     def _handle_shutdown(self):
         """Emergency turn off the external heater if Klipper crashes."""
         self._in_shutdown = True
@@ -775,23 +3322,77 @@ class PandaBreath:
             self._transport.set_target(0.)
         except Exception as exc:
             logger.warning(
-                "panda_breath: failed to force off on %s: %s", reason, exc)
+                "%s: failed to force off on %s: %s", self.name, reason, exc)
             try:
                 self._transport.set_target(0.)
             except Exception:
                 pass
 
+    # ── object binding ────────────────────────────────────────────────────────
+
+    def _lookup(self, name, default=None):
+        self._object_lookups += 1
+        return self.printer.lookup_object(name, default)
+
+    def _bind_objects(self):
+        """Resolve and cache the heater, MCU, PWM pin owner, heaters and
+        toolhead.
+
+        Runs at klippy:connect/ready; the reactor poll and set_pwm() then
+        only read the cached references.  If no heater is found the
+        binding is retried at most every REBIND_INTERVAL seconds.
+        """
+        self._next_bind = self.reactor.monotonic() + REBIND_INTERVAL
+        self._mcu = self._lookup('mcu')
+        self._toolhead = self._lookup('toolhead')
+        self._pheaters = pheaters = self._lookup('heaters')
+        heater = None
+        heaters = getattr(pheaters, 'heaters', {})
+        if pheaters is not None:
+            self._object_lookups += 1
+            try:
+                heater = pheaters.lookup_heater(self.name)
+            except Exception:
+                heater = None
+        if heater is None:
+            heater = self._lookup('heater_generic %s' % self.name)
+        if heater is None:
+            for hname, hobj in heaters.items():
+                if hname.endswith(self.name):
+                    heater = hobj
+                    break
+        self._pin_owner = None
+        if self._virtual_pin is not None:
+            for hobj in heaters.values():
+                if getattr(hobj, 'mcu_pwm', None) is self._virtual_pin:
+                    self._pin_owner = hobj
+                    break
+        self._heater = heater if heater is not None else self._pin_owner
+        self._bound = self._heater is not None
+        if not self._bound:
+            logger.warning("%s: no heater found", self.name)
+
+    def _invalidate_binding(self):
+        self._heater = None
+        self._pin_owner = None
+        self._mcu = None
+        self._pheaters = None
+        self._toolhead = None
+        self._bound = False
+        self._next_bind = 0.
+
+    def _bound_heater(self):
+        if not self._bound and self.reactor.monotonic() >= self._next_bind:
+            self._bind_objects()
+        return self._heater
+
     def _attach_heater_hook(self):
         if self._heater_set_temp_orig is not None:
             return
-        try:
-            pheaters = self.printer.lookup_object('heaters')
-            heater = pheaters.lookup_heater(self.name)
-        except Exception as exc:
-            logger.warning("panda_breath: unable to hook heater '%s': %s",
-                           self.name, exc)
+        heater = self._bound_heater()
+        if heater is None:
+            logger.warning("%s: unable to hook heater", self.name)
             return
-        self._heater = heater
         self._heater_set_temp_orig = heater.set_temp
 
         def wrapped_set_temp(degrees):
@@ -847,7 +3448,8 @@ class PandaBreath:
                 self.auto_hotbedtemp,
             )
         except Exception as exc:
-            logger.warning("panda_breath: failed to configure auto mode: %s", exc)
+            logger.warning("%s: failed to configure auto mode: %s",
+                           self.name, exc)
             if gcmd is not None:
                 raise gcmd.error("Failed to configure Panda Breath auto mode")
             raise
@@ -874,7 +3476,8 @@ class PandaBreath:
         try:
             self._transport.start_drying(temp, hours)
         except Exception as exc:
-            logger.warning("panda_breath: failed to start drying mode: %s", exc)
+            logger.warning("%s: failed to start drying mode: %s",
+                           self.name, exc)
             raise gcmd.error("Failed to start Panda Breath drying mode")
 
     cmd_PANDA_BREATH_DRY_STOP_help = "Stop Panda Breath filament drying"
@@ -883,6 +3486,228 @@ class PandaBreath:
         _ = gcmd
         self._force_device_off("dry stop command")
 
+    cmd_PANDA_BREATH_HISTORY_help = (
+        "Report chamber temperature history "
+        "(SECONDS=<s> RESOLUTION=<0|1|10|60> COUNT=<rows>)"
+    )
+
+    def _cmd_panda_breath_history(self, gcmd):
+        seconds = gcmd.get_float('SECONDS', 300., above=0.)
+        count = gcmd.get_int('COUNT', 30, minval=1)
+        resolution = gcmd.get_float('RESOLUTION', None, minval=0.)
+        if resolution is None:
+            tier = self._history.select(seconds, count)
+        else:
+            tier = self._history.tier(resolution)
+            if tier is None:
+                raise gcmd.error("RESOLUTION must be one of %s" % ", ".join(
+                    "%g" % t.period for t in self._history.tiers))
+        now = self.reactor.monotonic()
+        lines = []
+        low = high = None
+        total = samples = 0
+        for start, tmin, tmax, mean, heater, target, mode, n in tier.rows(
+                now - seconds):
+            if len(lines) < count:
+                lines.append("%7.1fs %5.1fC (%.1f-%.1f) heater %5.1fC "
+                             "target %4.1fC %s" % (
+                                 start - now, mean, tmin, tmax, heater,
+                                 target, HISTORY_MODES.get(mode, mode)))
+            low = tmin if low is None else min(low, tmin)
+            high = tmax if high is None else max(high, tmax)
+            total += mean * n
+            samples += n
+        if not samples:
+            gcmd.respond_info("%s: no history in the last %.0fs" % (
+                self.name, seconds))
+            return
+        lines.reverse()
+        lines.insert(0, "%s: %d samples in the last %.0fs, %.1f-%.1fC "
+                     "mean %.1fC (%s, newest last)" % (
+                         self.name, samples, seconds, low, high,
+                         total / samples,
+                         "%gs buckets" % tier.period if tier.period
+                         else "raw samples"))
+        gcmd.respond_info("\n".join(lines))
+
+    def get_history(self, seconds, resolution=None, max_rows=500):
+        """History rows of the last `seconds`, oldest first.
+
+        Each row is [unix time, min, max, mean, heater_temp, target, mode,
+        samples]; `resolution` picks a tier (0 = raw samples), otherwise
+        the finest tier with at most max_rows rows is used.
+        """
+        if resolution is None:
+            tier = self._history.select(seconds, max_rows)
+        else:
+            tier = self._history.tier(resolution)
+            if tier is None:
+                return None, []
+        now = self.reactor.monotonic()
+        wall = time.time() - now
+        rows = [[round(start + wall, 3), round(tmin, 2), round(tmax, 2),
+                 round(mean, 2), round(heater, 2), round(target, 2),
+                 mode, n]
+                for start, tmin, tmax, mean, heater, target, mode, n
+                in tier.rows(now - seconds)]
+        rows.reverse()
+        return tier.period, rows
+
+    cmd_PANDA_BREATH_ETA_help = (
+        "Estimate the time for the chamber to reach a temperature "
+        "(TARGET=<C>)"
+    )
+
+    def _cmd_panda_breath_eta(self, gcmd):
+        target = gcmd.get_float('TARGET', None, minval=0.0, maxval=80.0)
+        if target is None:
+            target = self.active_target()
+            if target is None:
+                raise gcmd.error("No active target; pass TARGET=<C>")
+        temp = self._smoother.value
+        fit = self._model.fit()
+        if fit is None:
+            gcmd.respond_info(
+                "%s: %.1fC, no usable thermal model yet"
+                % (self.name, temp))
+            return
+        model = "time constant %.1f min" % (fit["time_constant"] / 60.,)
+        if fit["steady_state"] is not None:
+            model += ", heats to %.1fC" % (fit["steady_state"],)
+        if fit["ambient"] is not None:
+            model += ", ambient %.1fC" % (fit["ambient"],)
+        eta = self._model.eta(temp, target, fit)
+        if eta is None:
+            msg = "%s: %.1fC, %.1fC is not reachable by the model" % (
+                self.name, temp, target)
+        else:
+            msg = "%s: %.1fC -> %.1fC in about %.1f min" % (
+                self.name, temp, target, eta / 60.)
+        gcmd.respond_info("%s (%s)" % (msg, model))
+
+    cmd_PANDA_BREATH_WAIT_help = (
+        "Reach and wait for a chamber temperature, heating with Klipper and "
+        "handing off to native auto mode (TARGET=<C> HOLD=0|1 BAND=<C> "
+        "STABLE=<s> TIMEOUT=<s>, or MINIMUM=<C> MAXIMUM=<C> to only wait)"
+    )
+
+    def _cmd_panda_breath_wait(self, gcmd):
+        target = gcmd.get_float('TARGET', None, minval=0.0, maxval=80.0)
+        minimum = gcmd.get_float('MINIMUM', None)
+        maximum = gcmd.get_float('MAXIMUM', None)
+        timeout = gcmd.get_float('TIMEOUT', 0., minval=0.)
+        stable = gcmd.get_float('STABLE', 0., minval=0.)
+        band = gcmd.get_float('BAND', self._wait_tolerance, minval=0.)
+        if target is None:
+            if minimum is None and maximum is None:
+                raise gcmd.error(
+                    "PANDA_BREATH_WAIT needs TARGET or MINIMUM/MAXIMUM")
+            if stable:
+                raise gcmd.error("STABLE requires TARGET")
+        elif minimum is not None or maximum is not None:
+            raise gcmd.error("Use either TARGET or MINIMUM/MAXIMUM")
+        deadline = None
+        if timeout:
+            deadline = self.reactor.monotonic() + timeout
+        if target is None:
+            low = minimum if minimum is not None else float('-inf')
+            high = maximum if maximum is not None else float('inf')
+            if maximum is None:
+                goal, goal_temp = "%.1fC" % (low,), low
+            elif minimum is None:
+                goal, goal_temp = "<= %.1fC" % (high,), high
+            else:
+                goal = "%.1f-%.1fC" % (low, high)
+                goal_temp = low if self.temperature < low else high
+            self._wait_until(
+                gcmd, lambda eventtime: low <= self.temperature <= high,
+                goal, goal_temp, deadline)
+            return
+        can_hold = callable(getattr(self._transport, "set_auto_mode", None))
+        hold = gcmd.get_int('HOLD', int(can_hold), minval=0, maxval=1)
+        if hold and not can_hold:
+            raise gcmd.error("Native Panda auto mode is only available with "
+                             "stock firmware transport")
+        filtertemp = int(gcmd.get_float(
+            'FILTERTEMP', float(self.auto_filtertemp), minval=0.0,
+            maxval=120.0))
+        hotbedtemp = int(gcmd.get_float(
+            'HOTBEDTEMP', float(self.auto_hotbedtemp), minval=0.0,
+            maxval=120.0))
+        if target <= 0.:
+            if self.auto_enabled:
+                self._set_auto_mode(False, self.auto_target, filtertemp,
+                                    hotbedtemp, gcmd=gcmd)
+            self.set_heater_target(0.)
+            return
+        tolerance = self._wait_tolerance
+        if self.temperature + tolerance < target:
+            # Heat with Klipper until the target is reached, as
+            # TEMPERATURE_WAIT MINIMUM does; only then may native auto mode
+            # hold it, since auto mode stops heating while the bed is below
+            # hotbedtemp
+            self.set_heater_target(target)
+            reached = self._wait_until(
+                gcmd, lambda eventtime: self.temperature >= target,
+                "%.1fC" % (target,), target, deadline)
+            if reached and hold:
+                self._set_auto_mode(True, int(target), filtertemp,
+                                    hotbedtemp, gcmd=gcmd)
+        else:
+            if hold:
+                self._set_auto_mode(True, int(target), filtertemp,
+                                    hotbedtemp, gcmd=gcmd)
+            else:
+                self.set_heater_target(target)
+            reached = self._wait_until(
+                gcmd, lambda eventtime: (self.temperature
+                                         <= target + tolerance),
+                "<= %.1fC" % (target + tolerance,), target, deadline)
+        if not reached or not stable:
+            return
+        settled = []
+
+        def in_band(eventtime):
+            if abs(self.temperature - target) > band:
+                del settled[:]
+                return False
+            if not settled:
+                settled.append(eventtime)
+            return eventtime - settled[0] >= stable
+        self._wait_until(gcmd, in_band, "%.1fC +/- %.1fC for %.0fs" % (
+            target, band, stable), target, deadline)
+
+    def _wait_until(self, gcmd, done, goal, goal_temp, deadline):
+        """Pause the G-code on the reactor until done(eventtime) is true.
+
+        Reports progress, with the estimated time to goal_temp, every
+        WAIT_REPORT_INTERVAL seconds.  Returns False if Klipper shuts
+        down; raises when the deadline passes.
+        """
+        toolhead = self._toolhead
+        eventtime = self.reactor.monotonic()
+        next_report = eventtime
+        while not self.printer.is_shutdown():
+            if done(eventtime):
+                return True
+            if deadline is not None and eventtime >= deadline:
+                raise gcmd.error("%s: timed out at %.1fC waiting for %s" % (
+                    self.name, self.temperature, goal))
+            if toolhead is not None:
+                # Flush queued moves, as TEMPERATURE_WAIT does
+                toolhead.get_last_move_time()
+            if eventtime >= next_report:
+                next_report = eventtime + WAIT_REPORT_INTERVAL
+                msg = "%s: %.1fC waiting for %s, %+.1fC/min" % (
+                    self.name, self.temperature, goal,
+                    self.temperature_slope)
+                eta = self.get_eta(goal_temp)
+                if eta is not None:
+                    msg += ", about %.1f min" % (eta / 60.,)
+                gcmd.respond_info(msg, log=False)
+            eventtime = self.reactor.pause(eventtime + 1.)
+        return False
+
     def _clear_heater_target_state(self):
         self._attach_heater_hook()
         if self._heater_set_temp_orig is None:
@@ -890,206 +3715,179 @@ class PandaBreath:
         try:
             self._heater_set_temp_orig(0.)
         except Exception as exc:
-            logger.debug("panda_breath: unable to clear heater target state: %s", exc)
+            logger.debug("%s: unable to clear heater target state: %s",
+                         self.name, exc)
 
     # ── state queue ───────────────────────────────────────────────────────────
 
     def _enqueue(self, data):
-        self._state_queue.append(data)
+        if "temperature" in data:
+            data["temperature_time"] = time.monotonic()
+        self._state_store.put(data)
+        if not self._wake_pending:
+            self._wake_pending = True
+            self.reactor.register_async_callback(self._handle_wake)
+
+    def _handle_wake(self, eventtime):
+        # Clear first: data queued from here on requests a fresh wake-up
+        self._wake_pending = False
+        if not self._poll_active:
+            return
+        waketime = max(eventtime, self._last_poll + self._min_poll_interval)
+        self.reactor.update_timer(self._poll_timer, waketime)
 
     def _on_disconnect(self):
+        # Runs on the I/O thread; only the reactor writes versioned state
+        self.reactor.register_async_callback(self._handle_transport_lost)
+
+    def _handle_transport_lost(self, eventtime):
         self.is_connected = False
 
+    def _update_clock(self):
+        """Measure the offset from time.monotonic() to the reactor clock.
+
+        Klipper's reactor uses CLOCK_MONOTONIC_RAW while the I/O thread
+        stamp samples with time.monotonic(), so the two are bracketed here
+        and the slow drift between them is tracked for diagnostics.
+        """
+        before = time.monotonic()
+        reactor_now = self.reactor.monotonic()
+        after = time.monotonic()
+        mono = (before + after) / 2.
+        self._clock_offset = reactor_now - mono
+        if self._clock_ref is None:
+            self._clock_ref = (mono, self._clock_offset)
+        elif mono - self._clock_ref[0] > 60.:
+            self._clock_drift_ppm = ((self._clock_offset - self._clock_ref[1])
+                                     / (mono - self._clock_ref[0]) * 1e6)
+
     def _reactor_poll(self, eventtime):
-        while self._state_queue:
-            data = self._state_queue.popleft()
+        self._last_poll = eventtime
+        self._update_clock()
+        updates = self._state_store.drain()
+        changed = bool(updates)
+        for data in updates:
             self.is_connected = True
-            temp = data.get("temperature")
-            if temp is not None:
-                self.temperature = float(temp)
-                self.smoothed_temp = self.temperature
-                self._last_temp_time = eventtime
-            if "work_mode" in data:
-                try:
-                    self.work_mode = int(data.get("work_mode"))
-                    if self.work_mode != 1:
-                        self.auto_enabled = False
-                except Exception:
-                    pass
-            if "work_on" in data:
-                parsed = _parse_bool(data.get("work_on"))
-                if parsed is None:
-                    parsed = bool(data.get("work_on"))
-                self.work_on = parsed
-                if self.work_mode == 1:
-                    self.auto_enabled = self.work_on
-            if "set_temp" in data:
-                try:
-                    self.device_target = float(data.get("set_temp"))
-                except Exception:
-                    pass
-            if "target_temp" in data:
-                try:
-                    target_temp = float(data.get("target_temp"))
-                    self.device_target = target_temp
-                    if self.work_mode == 1:
-                        self.auto_target = int(target_temp)
-                except Exception:
-                    pass
-            if "heater_temp" in data:
-                try:
-                    self.heater_temp = float(data.get("heater_temp"))
-                except Exception:
-                    pass
-            if "auto_target" in data:
-                try:
-                    self.auto_target = int(data.get("auto_target"))
-                except Exception:
-                    pass
-            if "auto_filtertemp" in data:
-                try:
-                    self.auto_filtertemp = int(data.get("auto_filtertemp"))
-                except Exception:
-                    pass
-            if "auto_hotbedtemp" in data:
-                try:
-                    self.auto_hotbedtemp = int(data.get("auto_hotbedtemp"))
-                except Exception:
-                    pass
-            if "filament_temp" in data:
-                try:
-                    self.filament_temp = int(data.get("filament_temp"))
-                except Exception:
-                    pass
-            if "filament_timer" in data:
-                try:
-                    self.filament_timer = int(data.get("filament_timer"))
-                except Exception:
-                    pass
-            if "remaining_seconds" in data:
-                try:
-                    self.remaining_seconds = int(data.get("remaining_seconds"))
-                    self.drying_remaining_min = int(
-                        (self.remaining_seconds + 59) // 60)
-                except Exception:
-                    pass
-            if "drying_remaining_min" in data:
-                try:
-                    self.drying_remaining_min = int(data.get("drying_remaining_min"))
-                    self.remaining_seconds = self.drying_remaining_min * 60
-                except Exception:
-                    pass
-            if "isrunning" in data:
-                parsed = _parse_bool(data.get("isrunning"))
-                if parsed is not None:
-                    self.filament_drying_active = parsed
-                    if not self.filament_drying_active:
-                        self.remaining_seconds = 0
-                        self.drying_remaining_min = 0
-            if "drying_running" in data:
-                parsed = _parse_bool(data.get("drying_running"))
-                if parsed is not None:
-                    self.filament_drying_active = parsed
-                    if not self.filament_drying_active:
-                        self.remaining_seconds = 0
-                        self.drying_remaining_min = 0
-            if "filament_drying_mode" in data:
-                try:
-                    self.work_mode = 3
-                except Exception:
-                    pass
-            if "filament_button" in data:
+            for field in sorted(data, key=_FIELD_ORDER.__getitem__):
+                self._FIELD_APPLY[field](self, data[field], eventtime)
+        if self._history_time is not None:
+            # Recorded after the whole update so heater_temp and mode
+            # received with the sample are included.  The target is the
+            # one the device works towards, so auto and drying show theirs
+            self._history.add(self._history_time, self.temperature,
+                              self.heater_temp, self.active_target() or 0.,
+                              self.work_mode if self.work_on else 0)
+            self._model.update(self._history_time, self._smoother.value,
+                               self._heating_phase())
+            self._history_time = None
+
+        # Report each new sample at the MCU print time it was received.
+        # Between samples the last reading is held (re-reported at the
+        # current time) once it is SAMPLE_HOLD old, so heater_generic keeps
+        # a valid temperature while verify_heater still sees real samples.
+        if self._sensor and self._sensor.callback and self._last_temp_time > 0:
+            if self._new_sample:
+                report_time = self._last_temp_time
+                self._new_sample = False
+            elif eventtime - self._last_temp_time >= SAMPLE_HOLD:
+                report_time = eventtime
+                self._held_reports += 1
+            else:
+                report_time = None
+            if report_time is not None:
                 try:
-                    self.filament_button = int(data.get("filament_button"))
+                    read_time = self._mcu.estimated_print_time(report_time)
                 except Exception:
-                    pass
+                    read_time = report_time
+                read_time = max(read_time, self._last_read_time)
+                self._last_read_time = read_time
+                self._sensor.callback(read_time, self.temperature)
 
-        # Keep the heater callback fresh every poll cycle and use MCU print
-        # time so verify_heater compares timestamps from the correct clock.
-        if self._sensor and self._sensor.callback and self._last_temp_time > 0:
-            try:
-                mcu = self.printer.lookup_object('mcu')
-                read_time = mcu.estimated_print_time(eventtime)
-            except Exception:
-                read_time = eventtime
-            self._sensor.callback(read_time, self.temperature)
-        
-        if (self._last_temp_time > 0. 
-                and eventtime - self._last_temp_time > TEMP_STALE_WARN):
+        if (self._last_temp_time > 0.
+                and eventtime - self._last_temp_time > TEMP_STALE_WARN
+                and eventtime >= self._next_stale_warn):
             logger.warning(
-                "panda_breath: temperature data stale (%.0fs)",
-                eventtime - self._last_temp_time)
-            self._last_temp_time = eventtime
+                "%s: temperature data stale (%.0fs)",
+                self.name, eventtime - self._last_temp_time)
+            self._next_stale_warn = eventtime + TEMP_STALE_WARN
 
         # Keep device target synchronized with heater target even if no PWM
         # callback arrives (seen on some modified Klipper builds).
-        heater_target = self._lookup_heater_target()
-        if heater_target is None:
-            try:
-                webhooks = self.printer.lookup_object('webhooks')
-                all_status = webhooks.get_status(eventtime)
-                hstatus = all_status.get('heater_generic %s' % self.name)
-                if isinstance(hstatus, dict):
-                    heater_target = hstatus.get('target')
-            except Exception:
-                pass
+        heater_target = self.heater_target()
         if heater_target is not None and abs(float(heater_target) - self.target) > 0.01:
             heater_target = float(heater_target)
             if self.work_mode in (1, 3):
                 logger.debug(
-                    "panda_breath: ignoring synced heater target %.1f while mode=%s",
-                    heater_target, self.work_mode)
+                    "%s: ignoring synced heater target %.1f while mode=%s",
+                    self.name, heater_target, self.work_mode)
             elif self._external_off_lockout and heater_target > 0.:
                 logger.info(
-                    "panda_breath: ignoring synced heater target %.1f after forced off",
-                    heater_target)
+                    "%s: ignoring synced heater target %.1f after forced off",
+                    self.name, heater_target)
             else:
                 self.set_device_target(heater_target)
-        
-        return eventtime + REACTOR_POLL
+                changed = True
 
-    def _lookup_heater_target(self):
-        try:
-            pheaters = self.printer.lookup_object('heaters')
-            if self._heater is None:
-                try:
-                    self._heater = pheaters.lookup_heater(self.name)
-                except Exception:
-                    self._heater = None
-            if self._heater is not None:
-                return float(getattr(self._heater, 'target_temp', 0.0))
+        if changed or self.work_on or self.target > 0.:
+            return eventtime + self._poll_interval
+        return eventtime + self._idle_poll_interval
 
-            try:
-                hobj = self.printer.lookup_object('heater_generic %s' % self.name)
-                if hobj is not None:
-                    return float(getattr(hobj, 'target_temp', 0.0))
-            except Exception:
-                pass
+    def heater_target(self, pin_owner=False):
+        """Target of the bound heater (or of the PWM pin's owner), or None."""
+        heater = self._bound_heater()
+        if pin_owner and self._pin_owner is not None:
+            heater = self._pin_owner
+        if heater is None:
+            return None
+        return float(getattr(heater, 'target_temp', 0.))
 
-            heater = pheaters.heaters.get(self.name)
-            if heater is None:
-                for hname, hobj in pheaters.heaters.items():
-                    if hname.endswith(self.name):
-                        heater = hobj
-                        break
-            if heater is not None:
-                return float(getattr(heater, 'target_temp', 0.0))
+    def set_heater_target(self, degrees):
+        """Set the heater target, mirrored to the device by the heater hook.
 
-            if self._virtual_pin is None:
-                return None
-            for _, heater in pheaters.heaters.items():
-                if getattr(heater, 'mcu_pwm', None) == self._virtual_pin:
-                    return float(getattr(heater, 'target_temp', 0.0))
-        except Exception:
-            pass
+        Without a bound heater the target goes to the device directly.
+        """
+        heater = self._bound_heater()
+        if heater is None:
+            self.set_device_target(degrees)
+            return
+        self._pheaters.set_temperature(heater, degrees)
+
+    def active_target(self):
+        """Temperature the device is currently working towards, or None."""
+        if self.work_mode == 3 and self.filament_drying_active:
+            return float(self.filament_temp)
+        if self.work_mode == 1 and self.auto_enabled:
+            return float(self.auto_target)
+        if self.target > 0.:
+            return self.target
+        return None
+
+    def _heating_phase(self):
+        """Thermal model input: True while heating flat out, False while
+        off, None while regulating near the target."""
+        if not self.work_on:
+            return False
+        target = self.active_target()
+        if (target is not None and self._smoother.value
+                < target - MODEL_REGULATION_BAND):
+            return True
         return None
 
+    def get_eta(self, target=None):
+        """Estimated seconds for the chamber to reach `target` (default
+        the active target), or None if the model cannot tell yet."""
+        if target is None:
+            target = self.active_target()
+            if target is None:
+                return None
+        return self._model.eta(self._smoother.value, target)
+
     def set_device_target(self, degrees):
         """Send target to device. Only sends if changed or 0."""
         if self._in_shutdown and float(degrees) > 0.:
             logger.info(
-                "panda_breath: ignoring target %.1f while Klipper is shutdown",
-                float(degrees))
+                "%s: ignoring target %.1f while Klipper is shutdown",
+                self.name, float(degrees))
             return
         self.auto_enabled = False
         self.work_mode = 2
@@ -1101,28 +3899,146 @@ class PandaBreath:
         self.drying_remaining_min = 0
         self._transport.set_target(degrees)
 
+    # ── state field application (one entry per _STATE_FIELDS field) ──────────
+
+    def _apply_temperature_time(self, value, eventtime):
+        self._sample_mono = value
+
+    def _apply_temperature(self, value, eventtime):
+        self.temperature = value
+        sample_time = eventtime
+        if self._sample_mono:
+            sample_time = min(eventtime, self._sample_mono + self._clock_offset)
+        smoother = self._smoother
+        self.smoothed_temp = round(smoother.update(sample_time, value), 2)
+        self.temperature_slope = round(smoother.slope * 60., 3)
+        if self._estimate_period and self._last_temp_time > 0.:
+            interval = sample_time - self._last_temp_time
+            if self._sample_period is None:
+                self._sample_period = interval
+            else:
+                self._sample_period += 0.1 * (interval - self._sample_period)
+        self._last_temp_time = sample_time
+        self._new_sample = True
+        self._history_time = sample_time
+
+    def _apply_work_mode(self, value, eventtime):
+        self.work_mode = value
+        if value != 1:
+            self.auto_enabled = False
+
+    def _apply_work_on(self, value, eventtime):
+        self.work_on = value
+        if self.work_mode == 1:
+            self.auto_enabled = value
+
+    def _apply_set_temp(self, value, eventtime):
+        self.device_target = value
+
+    def _apply_target_temp(self, value, eventtime):
+        self.device_target = value
+        if self.work_mode == 1:
+            self.auto_target = int(value)
+
+    def _apply_remaining_seconds(self, value, eventtime):
+        self.remaining_seconds = value
+        self.drying_remaining_min = (value + 59) // 60
+
+    def _apply_drying_remaining_min(self, value, eventtime):
+        self.drying_remaining_min = value
+        self.remaining_seconds = value * 60
+
+    def _apply_drying_active(self, value, eventtime):
+        self.filament_drying_active = value
+        if not value:
+            self.remaining_seconds = 0
+            self.drying_remaining_min = 0
+
+    def _apply_filament_drying_mode(self, value, eventtime):
+        self.work_mode = 3
+
+    def _setter(attr):
+        def apply(self, value, eventtime):
+            setattr(self, attr, value)
+        return apply
+
+    _FIELD_APPLY = {
+        "temperature_time": _apply_temperature_time,
+        "temperature": _apply_temperature,
+        "work_mode": _apply_work_mode,
+        "work_on": _apply_work_on,
+        "set_temp": _apply_set_temp,
+        "target_temp": _apply_target_temp,
+        "heater_temp": _setter("heater_temp"),
+        "auto_target": _setter("auto_target"),
+        "auto_filtertemp": _setter("auto_filtertemp"),
+        "auto_hotbedtemp": _setter("auto_hotbedtemp"),
+        "filament_temp": _setter("filament_temp"),
+        "filament_timer": _setter("filament_timer"),
+        "remaining_seconds": _apply_remaining_seconds,
+        "drying_remaining_min": _apply_drying_remaining_min,
+        "isrunning": _apply_drying_active,
+        "drying_running": _apply_drying_active,
+        "filament_drying_mode": _apply_filament_drying_mode,
+        "filament_button": _setter("filament_button"),
+        "fan_on": _setter("fan_on"),
+        "fan_speed": _setter("fan_speed"),
+    }
+    del _setter
+
     def get_status(self, eventtime):
-        return {
-            "temperature": self.temperature,
-            "target": self.target,
-            "smoothed_temp": self.smoothed_temp,
-            "connected": self.is_connected,
-            "work_mode": self.work_mode,
-            "work_on": self.work_on,
-            "device_target": self.device_target,
-            "heater_temp": self.heater_temp,
-            "auto_enabled": self.auto_enabled,
-            "auto_target": self.auto_target,
-            "auto_filtertemp": self.auto_filtertemp,
-            "auto_hotbedtemp": self.auto_hotbedtemp,
-            "filament_temp": self.filament_temp,
-            "filament_timer": self.filament_timer,
-            "remaining_seconds": self.remaining_seconds,
-            "drying_remaining_min": self.drying_remaining_min,
-            "filament_button": self.filament_button,
-            "filament_drying_active": self.filament_drying_active,
-        }
+        """Read-only status snapshot.
+
+        The fields are rebuilt only when the state version changes, so the
+        many get_status() calls between updates share one object.
+        sample_age is the one field refreshed on its own, as of the latest
+        poll; the nested transport and model dicts are as of the last state
+        change and stay plain dicts, as Klipper JSON-encodes them.
+        """
+        version = self.state.version
+        if version != self._status_version:
+            self._status_version = version
+            self._status_fields = self._build_status()
+            self._status = None
+        sample_age = (round(max(0., self._last_poll - self._last_temp_time), 3)
+                      if self._last_temp_time > 0. else None)
+        if self._status is None or sample_age != self._status_age:
+            self._status_age = sample_age
+            status = dict(self._status_fields)
+            status["sample_age"] = sample_age
+            self._status = types.MappingProxyType(status)
+        return self._status
+
+    def _build_status(self):
+        status = self.state.as_dict()
+        status.update({
+            "state_version": self.state.version,
+            "updates_received": self._state_store.seq,
+            "updates_coalesced": self._state_store.dropped,
+            "object_lookups": self._object_lookups,
+            "sample_period": (round(self._sample_period, 3)
+                              if self._sample_period is not None else None),
+            "held_reports": self._held_reports,
+            "clock_offset": round(self._clock_offset, 6),
+            "clock_drift_ppm": round(self._clock_drift_ppm, 3),
+            "transport": self._transport.get_stats(),
+        })
+        fit = self._model.fit()
+        target = self.active_target()
+        eta = None
+        if fit is not None and target is not None:
+            eta = self._model.eta(self._smoother.value, target, fit)
+        model = {"steps": sum(self._model.steps)}
+        for key in ("time_constant", "ambient", "gain", "steady_state"):
+            value = fit[key] if fit is not None else None
+            model[key] = round(value, 2) if value is not None else None
+        status["eta"] = round(eta) if eta is not None else None
+        status["model"] = model
+        return status
 
+    def get_status_delta(self, since):
+        """Return (version, {field: value}) for fields changed after `since`."""
+        return self.state.version, self.state.delta(since)
 
 class PandaBreathSensor:
     """Implements the Klipper sensor interface for heater_generic."""
@@ -1130,16 +4046,22 @@ class PandaBreathSensor:
         self.printer = config.get_printer()
         self.module = module
         self.callback = None
+        self._status = None
+        self._status_version = None
 
     def get_temp(self, eventtime):
         return self.module.temperature, self.module.target
 
     def get_status(self, eventtime):
-        return {
-            "temperature": self.module.temperature,
-            "target": self.module.target,
-            "smoothed_temp": self.module.smoothed_temp,
-        }
+        state = self.module.state
+        if state.version != self._status_version:
+            self._status_version = state.version
+            self._status = types.MappingProxyType({
+                "temperature": state.temperature,
+                "target": state.target,
+                "smoothed_temp": state.smoothed_temp,
+            })
+        return self._status
 
     def setup_minmax(self, min_temp, max_temp):
         pass
@@ -1148,7 +4070,9 @@ class PandaBreathSensor:
         self.callback = cb
 
     def get_report_time_delta(self):
-        return 1.0
+        # Read once when the heater is built, before any sample arrives,
+        # so this is the configured period rather than the live estimate
+        return self.module.report_period
 
     def set_read_tolerance(self, range_check_val, range_check_time):
         pass
@@ -1164,7 +4088,7 @@ class PandaBreathVirtualPin:
         return self.module.printer.lookup_object('mcu')
 
     def set_pwm(self, print_time, value, cycle_time=None):
-        target = self._lookup_heater_target()
+        target = self.module.heater_target(pin_owner=True)
         if target is not None:
             if target <= 0:
                 if self.module.target != 0:
@@ -1175,16 +4099,6 @@ class PandaBreathVirtualPin:
                 self.module.set_device_target(target)
         self.last_value = value
 
-    def _lookup_heater_target(self):
-        try:
-            pheaters = self.module.printer.lookup_object('heaters')
-            for name, heater in pheaters.heaters.items():
-                if getattr(heater, 'mcu_pwm', None) == self:
-                    return heater.target_temp
-        except Exception:
-            pass
-        return None
-
     def setup_max_duration(self, max_duration):
         pass
 
@@ -1192,5 +4106,148 @@ class PandaBreathVirtualPin:
         pass
 
 
+class PandaBreathGroup:
+    """Every configured Panda Breath, addressed as one enclosure heater.
+
+    Created by the first device and registered as the printer object
+    "panda_breath_group".  PANDA_BREATH_GROUP sets one target on all
+    devices (or the DEVICES subset) in a single reactor pass; each
+    transport only queues its command, so the commands go out together
+    on the shared I/O loop.  get_status() reports the average chamber
+    temperature of the connected devices.
+
+    Also serves the "panda_breath/status" webhooks endpoint: the full
+    status of one device, or with `since` only the state fields changed
+    after that state_version; and "panda_breath/history", its
+    min/max/mean temperature buckets.
+    """
+
+    def __init__(self, printer):
+        self.printer = printer
+        self.devices = []
+        gcode = printer.lookup_object('gcode')
+        gcode.register_command(
+            'PANDA_BREATH_GROUP', self._cmd_panda_breath_group,
+            desc=self.cmd_PANDA_BREATH_GROUP_help)
+        webhooks = printer.lookup_object('webhooks')
+        webhooks.register_endpoint(
+            "panda_breath/status", self._handle_status_request)
+        webhooks.register_endpoint(
+            "panda_breath/history", self._handle_history_request)
+
+    @classmethod
+    def lookup(cls, printer):
+        group = printer.lookup_object('panda_breath_group', None)
+        if group is None:
+            group = cls(printer)
+            printer.add_object('panda_breath_group', group)
+        return group
+
+    def add(self, module):
+        self.devices.append(module)
+
+    def _find(self, name):
+        for module in self.devices:
+            if name in (module.device, module.name):
+                return module
+        return None
+
+    def _select(self, gcmd):
+        names = gcmd.get('DEVICES', None)
+        if names is None:
+            return list(self.devices)
+        selected = []
+        for name in names.split(','):
+            name = name.strip()
+            if not name:
+                continue
+            module = self._find(name)
+            if module is None:
+                raise gcmd.error("Unknown Panda Breath device '%s'" % name)
+            selected.append(module)
+        return selected
+
+    def _request_module(self, web_request):
+        name = web_request.get_str('device', None)
+        module = self._find(name)
+        if module is None:
+            raise web_request.error(
+                "Unknown Panda Breath device '%s'" % (name,))
+        return module
+
+    def _handle_history_request(self, web_request):
+        module = self._request_module(web_request)
+        seconds = web_request.get_float('seconds', 600.)
+        resolution = web_request.get_float('resolution', None)
+        resolution, rows = module.get_history(seconds, resolution)
+        if resolution is None:
+            raise web_request.error("Unknown history resolution")
+        web_request.send({
+            "resolution": resolution,
+            "fields": ["time", "min", "max", "mean", "heater_temp",
+                       "target", "mode", "samples"],
+            "modes": HISTORY_MODES,
+            "buckets": rows,
+        })
+
+    def _handle_status_request(self, web_request):
+        module = self._request_module(web_request)
+        since = web_request.get_int('since', None)
+        if since is None:
+            eventtime = self.printer.get_reactor().monotonic()
+            status = module.get_status(eventtime)
+            web_request.send({"version": module.state.version,
+                              "status": dict(status)})
+            return
+        version, changed = module.get_status_delta(since)
+        web_request.send({"version": version, "changed": changed})
+
+    @staticmethod
+    def _temperatures(modules):
+        return [module.temperature for module in modules
+                if module.is_connected and module._last_temp_time > 0.]
+
+    cmd_PANDA_BREATH_GROUP_help = (
+        "Set a target on every Panda Breath and report the average "
+        "chamber temperature (TARGET=<C> DEVICES=<name,...>)"
+    )
+
+    def _cmd_panda_breath_group(self, gcmd):
+        modules = self._select(gcmd)
+        target = gcmd.get_float('TARGET', None, minval=0.0, maxval=80.0)
+        if target is not None:
+            for module in modules:
+                module.set_heater_target(target)
+        lines = []
+        for module in modules:
+            if module.is_connected:
+                lines.append("%s: %.1fC target %.1fC" % (
+                    module.name, module.temperature, module.target))
+            else:
+                lines.append("%s: disconnected" % (module.name,))
+        temps = self._temperatures(modules)
+        if temps:
+            lines.append("average: %.1fC (%d/%d devices)" % (
+                sum(temps) / len(temps), len(temps), len(modules)))
+        gcmd.respond_info("\n".join(lines))
+
+    def get_status(self, eventtime):
+        temps = self._temperatures(self.devices)
+        return {
+            "devices": [module.name for module in self.devices],
+            "connected": len(temps),
+            "temperature": (round(sum(temps) / len(temps), 2)
+                            if temps else None),
+            "min_temperature": min(temps) if temps else None,
+            "max_temperature": max(temps) if temps else None,
+            "targets": {module.name: module.target
+                        for module in self.devices},
+        }
+
+
 def load_config(config):
     return PandaBreath(config)
+
+
+def load_config_prefix(config):
+    return PandaBreath(config)
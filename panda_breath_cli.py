@@ -3,6 +3,7 @@
 
 This tool talks directly to the Panda Breath WebSocket API using only Python
 stdlib modules. Host installation is intentionally handled by install.sh.
+Frame masking is shared with panda_breath.py, which sits next to this file.
 
 panda_breath_cli.py created by paxx12, licensed under GPLv3.
 """
@@ -17,6 +18,8 @@ import sys
 import time
 from time import sleep
 
+from panda_breath import _ws_mask
+
 
 DEFAULT_PANDA_HOST = "PandaBreath.local"
 DEFAULT_PANDA_PORT = 80
@@ -92,7 +95,7 @@ class PandaBreathClient:
         payload = text.encode("utf-8")
         length = len(payload)
         mask = os.urandom(4)
-        masked = bytes(b ^ mask[i & 3] for i, b in enumerate(payload))
+        masked = _ws_mask(payload, mask)
         if length < 126:
             header = struct.pack("!BB", 0x81, 0x80 | length)
         elif length < 65536:
@@ -131,7 +134,7 @@ class PandaBreathClient:
             mask_key = recv_exact(4) if masked else None
             payload = recv_exact(length)
             if masked:
-                payload = bytes(b ^ mask_key[i & 3] for i, b in enumerate(payload))
+                payload = _ws_mask(payload, mask_key)
             if opcode == 0x8:
                 raise ConnectionError("WS: server closed connection")
             if opcode == 0x1:
@@ -28,7 +28,7 @@ def main():
     # Monkey patch dispatch to see raw incoming messages
     orig_dispatch = transport._dispatch
     def debug_dispatch(payload):
-        print(f"\n[DEVICE -> CLIENT] {payload.decode('utf-8', errors='replace')}")
+        print(f"\n[DEVICE -> CLIENT] {bytes(payload).decode('utf-8', errors='replace')}")
         return orig_dispatch(payload)
     transport._dispatch = debug_dispatch
 
@@ -0,0 +1,54 @@
+"""_ws_mask must match the byte-wise XOR it replaced, byte for byte."""
+
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from panda_breath import _ws_mask  # noqa: E402
+
+MASKS = (b"\x00\x00\x00\x00", b"\xff\xff\xff\xff", b"\x12\x34\x56\x78",
+         b"\x80\x01\xfe\x7f")
+LENGTHS = (0, 1, 2, 3, 4, 5, 7, 8, 12, 16, 125, 126, 127, 1021, 4096,
+           65535, 65536, 70001)
+
+
+def reference_mask(data, mask):
+    return bytes(b ^ mask[i & 3] for i, b in enumerate(data))
+
+
+def payload(length):
+    return bytes((i * 131 + 7) & 0xff for i in range(length))
+
+
+@pytest.mark.parametrize("mask", MASKS)
+@pytest.mark.parametrize("length", LENGTHS)
+def test_matches_reference(length, mask):
+    data = payload(length)
+    expected = reference_mask(data, mask)
+    for view in (data, bytearray(data), memoryview(data)):
+        assert _ws_mask(view, mask) == expected
+
+
+@pytest.mark.parametrize("offset", (1, 2, 3, 5))
+def test_unaligned_view(offset):
+    # Payloads unmasked in place start at an arbitrary buffer offset
+    mask = b"\x12\x34\x56\x78"
+    buf = bytearray(payload(offset + 1000))
+    view = memoryview(buf)[offset:]
+    assert _ws_mask(view, mask) == reference_mask(bytes(view), mask)
+    assert _ws_mask(view, memoryview(buf)[:4]) == reference_mask(
+        bytes(view), bytes(buf[:4]))
+
+
+@pytest.mark.parametrize("length", (0, 1, 3, 4, 9, 4096))
+def test_involution(length):
+    data = payload(length)
+    mask = b"\x80\x01\xfe\x7f"
+    assert _ws_mask(_ws_mask(data, mask), mask) == data
+
+
+def test_empty_returns_bytes():
+    assert _ws_mask(b"", b"\x12\x34\x56\x78") == b""
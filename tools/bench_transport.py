@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+"""Microbenchmarks for the panda_breath.py transport hot paths.
+
+Replays synthetic device traffic through an in-memory socket so the numbers
+reflect parser/codec cost only, not the network. Each benchmark runs the
+current implementation next to a verbatim copy of the code it replaced.
+
+CPython has no allocation counter, so "allocations" are reported as socket
+reads per frame (each legacy read allocated a fresh bytes object and a
+bytearray copy) together with the tracemalloc peak while parsing.
+
+Usage:
+    python3 tools/bench_transport.py ws-parse [--frames N] [--size BYTES]
+    python3 tools/bench_transport.py mask
+    python3 tools/bench_transport.py mqtt-parse [--packets N] [--rate HZ]
+                                                [--capture FILE]
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import panda_breath  # noqa: E402
+
+# Typical TCP segment payload on the device's WiFi link
+SEGMENT = 1460
+
+
+class ReplaySocket:
+    """Serves a pre-recorded byte stream in segment-sized reads."""
+
+    def __init__(self, data: bytes, segment: int = SEGMENT):
+        self._data = memoryview(data)
+        self._pos = 0
+        self._segment = segment
+        self.reads = 0
+
+    def _take(self, n: int) -> memoryview:
+        n = min(n, self._segment, len(self._data) - self._pos)
+        chunk = self._data[self._pos:self._pos + n]
+        self._pos += n
+        self.reads += 1
+        return chunk
+
+    def recv(self, n: int) -> bytes:
+        return bytes(self._take(n))
+
+    def recv_into(self, view) -> int:
+        chunk = self._take(len(view))
+        view[:len(chunk)] = chunk
+        return len(chunk)
+
+
+# ── legacy implementations (as shipped before the rewrite) ───────────────────
+
+def legacy_recv_exact(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            raise ConnectionError("WS: connection closed mid-frame")
+        buf.extend(chunk)
+    return bytes(buf)
+
+
+def legacy_recv_frame(sock):
+    header = legacy_recv_exact(sock, 2)
+    opcode = header[0] & 0x0F
+    masked = bool(header[1] & 0x80)
+    length = header[1] & 0x7F
+    if length == 126:
+        length = struct.unpack("!H", legacy_recv_exact(sock, 2))[0]
+    elif length == 127:
+        length = struct.unpack("!Q", legacy_recv_exact(sock, 8))[0]
+    mask_key = legacy_recv_exact(sock, 4) if masked else None
+    payload = legacy_recv_exact(sock, length)
+    if masked:
+        payload = bytes(b ^ mask_key[i & 3] for i, b in enumerate(payload))
+    return opcode, payload
+
+
+def legacy_mask(data, mask):
+    return bytes(b ^ mask[i & 3] for i, b in enumerate(data))
+
+
+def legacy_mqtt_remaining_length(sock):
+    multiplier, value = 1, 0
+    for _ in range(4):
+        byte = ord(legacy_recv_exact(sock, 1))
+        value += (byte & 0x7F) * multiplier
+        multiplier <<= 7
+        if not (byte & 0x80):
+            break
+    return value
+
+
+def legacy_mqtt_recv_packet(sock):
+    first = ord(legacy_recv_exact(sock, 1))
+    remaining = legacy_mqtt_remaining_length(sock)
+    body = legacy_recv_exact(sock, remaining) if remaining else b""
+    return (first >> 4) & 0xF, first & 0xF, body
+
+
+# ── helpers ──────────────────────────────────────────────────────────────────
+
+def server_frame(payload: bytes, opcode: int = 0x1) -> bytes:
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", 0x80 | opcode, length)
+    elif length < 65536:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+    return header + payload
+
+
+def state_payload(size: int) -> bytes:
+    settings = {"warehouse_temper": 41.5, "cal_warehouse_temp": 41.2,
+                "work_mode": 2, "work_on": True, "set_temp": 45}
+    text = json.dumps({"settings": settings})
+    if len(text) < size:
+        settings["pad"] = "x" * (size - len(text) - 10)
+        text = json.dumps({"settings": settings})
+    return text.encode()
+
+
+def mqtt_publish(topic: str, payload: str) -> bytes:
+    body = struct.pack("!H", len(topic)) + topic.encode() + payload.encode()
+    return (b"\x30" + panda_breath._MqttTransport._encode_remaining_length(
+        len(body)) + body)
+
+
+def esphome_stream(packets: int) -> list:
+    """Publishes in the mix the ESPHome firmware sends, one per packet."""
+    prefix = "panda_breath"
+    topics = (
+        ("sensor/chamber_temperature/state",
+         lambda i: "%.1f" % (40 + i % 50 / 10.)),
+        ("sensor/ptc_element_temperature/state",
+         lambda i: "%.1f" % (80 + i % 90 / 10.)),
+        ("climate/chamber/current_temperature/state",
+         lambda i: "%.1f" % (40 + i % 50 / 10.)),
+        ("climate/chamber/mode/state", lambda i: "heat"),
+        ("fan/chamber_fan/state", lambda i: "ON"),
+    )
+    stream = []
+    for i in range(packets):
+        topic, value = topics[i % len(topics)]
+        stream.append(mqtt_publish("%s/%s" % (prefix, topic), value(i)))
+    return stream
+
+
+def load_capture(path: Path) -> list:
+    """Split a raw broker->client TCP payload dump into MQTT packets."""
+    reader = panda_breath._MqttPacketReader()
+    reader.feed(path.read_bytes())
+    packets = []
+    while True:
+        packet = reader.next_packet()
+        if packet is None:
+            return packets
+        ptype, flags, body = packet
+        packets.append(bytes([ptype << 4 | flags])
+                       + panda_breath._MqttTransport._encode_remaining_length(
+                           len(body)) + bytes(body))
+
+
+def measure(label, frames, run):
+    start = time.perf_counter()
+    reads = run()
+    elapsed = time.perf_counter() - start
+    # Separate pass: tracemalloc slows allocation-heavy code disproportionately
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("  %-8s %10.0f frames/s  %6.2f reads/frame  peak %7.1f KiB" % (
+        label, frames / elapsed, reads / frames, peak / 1024.))
+
+
+# ── benchmarks ───────────────────────────────────────────────────────────────
+
+def bench_ws_parse(args):
+    payload = state_payload(args.size)
+    stream = server_frame(payload) * args.frames
+    print("ws-parse: %d frames of %d bytes" % (args.frames, len(payload)))
+
+    def legacy():
+        sock = ReplaySocket(stream)
+        for _ in range(args.frames):
+            legacy_recv_frame(sock)
+        return sock.reads
+
+    def current():
+        sock = ReplaySocket(stream)
+        reader = panda_breath._WsFrameReader()
+        count = 0
+        while count < args.frames:
+            if reader.next_message() is None:
+                reader.fill(sock)
+            else:
+                count += 1
+        return sock.reads
+
+    measure("before", args.frames, legacy)
+    measure("after", args.frames, current)
+
+
+def bench_mqtt_parse(args):
+    if args.capture:
+        packets = load_capture(args.capture)
+        source = str(args.capture)
+    else:
+        packets = esphome_stream(args.packets)
+        source = "synthetic ESPHome"
+    count = len(packets)
+    stream = b"".join(packets)
+    print("mqtt-parse: %d packets (%s, %d bytes)" % (count, source,
+                                                     len(stream)))
+
+    def legacy():
+        sock = ReplaySocket(stream)
+        for _ in range(count):
+            legacy_mqtt_recv_packet(sock)
+        return sock.reads
+
+    def current():
+        sock = ReplaySocket(stream)
+        reader = panda_breath._MqttPacketReader()
+        done = 0
+        while done < count:
+            if reader.next_packet() is None:
+                reader.fill(sock)
+            else:
+                done += 1
+        return sock.reads
+
+    measure("before", count, legacy)
+    measure("after", count, current)
+    if args.rate:
+        paced(packets[:int(args.rate * args.seconds)], args.rate)
+
+
+class CountingSocket:
+    """Wraps a real socket and counts receive syscalls."""
+
+    def __init__(self, sock):
+        self._sock = sock
+        self.reads = 0
+
+    def recv(self, n):
+        self.reads += 1
+        return self._sock.recv(n)
+
+    def recv_into(self, view):
+        self.reads += 1
+        return self._sock.recv_into(view)
+
+
+def paced(packets, rate):
+    """Replay packets over a socketpair at a fixed rate, as a broker would."""
+    print("paced replay at %.0f Hz (%d packets):" % (rate, len(packets)))
+
+    def send(sock):
+        period = 1. / rate
+        due = time.perf_counter()
+        for packet in packets:
+            due += period
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            sock.sendall(packet)
+
+    def run(label, parse):
+        ours, theirs = socket.socketpair()
+        sender = threading.Thread(target=send, args=(theirs,))
+        sock = CountingSocket(ours)
+        sender.start()
+        start = time.thread_time()
+        parse(sock, len(packets))
+        cpu = time.thread_time() - start
+        sender.join()
+        ours.close()
+        theirs.close()
+        print("  %-8s %8.1f us CPU/packet  %6.2f reads/packet  %5.1f%% CPU"
+              % (label, cpu / len(packets) * 1e6, sock.reads / len(packets),
+                 cpu * rate / len(packets) * 100.))
+
+    def legacy(sock, count):
+        for _ in range(count):
+            legacy_mqtt_recv_packet(sock)
+
+    def current(sock, count):
+        reader = panda_breath._MqttPacketReader()
+        done = 0
+        while done < count:
+            if reader.next_packet() is None:
+                reader.fill(sock)
+            else:
+                done += 1
+
+    run("before", legacy)
+    run("after", current)
+
+
+def bench_mask(args):
+    mask = os.urandom(4)
+    cases = (
+        ("control", json.dumps({"settings": {"work_on": False}}).encode()),
+        ("command", state_payload(180)),
+        ("snapshot", state_payload(4096)),
+        ("snapshot", state_payload(16384)),
+    )
+    for label, payload in cases:
+        rounds = max(20, 2000000 // (len(payload) + 200))
+        timings = []
+        for func in (legacy_mask, panda_breath._ws_mask):
+            start = time.perf_counter()
+            for _ in range(rounds):
+                func(payload, mask)
+            timings.append((time.perf_counter() - start) / rounds)
+        print("  %-8s %6d bytes  before %8.2f us  after %7.2f us  (%.0fx)" % (
+            label, len(payload), timings[0] * 1e6, timings[1] * 1e6,
+            timings[0] / timings[1]))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="bench", required=True)
+    ws = sub.add_parser("ws-parse", help="WebSocket frame parsing")
+    ws.add_argument("--frames", type=int, default=20000)
+    ws.add_argument("--size", type=int, default=180,
+                    help="payload size (default: typical state push)")
+    ws.set_defaults(func=bench_ws_parse)
+    mask = sub.add_parser("mask", help="WebSocket XOR masking")
+    mask.set_defaults(func=bench_mask)
+    mqtt = sub.add_parser("mqtt-parse", help="MQTT packet decoding")
+    mqtt.add_argument("--packets", type=int, default=20000)
+    mqtt.add_argument("--capture", type=Path,
+                      help="raw broker->client byte stream to replay "
+                           "instead of the synthetic one")
+    mqtt.add_argument("--rate", type=float, default=1000.,
+                      help="paced replay rate in Hz (0 to skip)")
+    mqtt.add_argument("--seconds", type=float, default=3.,
+                      help="paced replay duration")
+    mqtt.set_defaults(func=bench_mqtt_parse)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
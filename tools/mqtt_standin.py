@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""Local stand-in MQTT broker for exercising the panda_breath.py MQTT client.
+
+Speaks just enough MQTT 3.1.1 (CONNECT, SUBSCRIBE, PUBLISH QoS 0/1,
+PUBACK, PINGREQ, DISCONNECT) to run the ESPHome transport against it, and
+can misbehave on purpose so QoS 1 retransmission and keepalive handling
+can be watched without flaky Wi-Fi:
+
+    --drop-puback P     drop each PUBACK with probability P
+    --puback-delay S    delay each PUBACK by S seconds
+    --no-pingresp       never answer PINGREQ
+
+Every packet received is logged with its packet id and DUP flag.  Lines
+typed on stdin as "<topic> <payload>" are published to all subscribers,
+e.g. "panda-breath/sensor/chamber_temperature/state 41.5".
+
+Usage:
+    python3 tools/mqtt_standin.py [--port 1883] [--drop-puback 0.3]
+"""
+
+from __future__ import annotations
+
+import argparse
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+
+
+def encode_length(n: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = n & 0x7F
+        n >>= 7
+        if n:
+            byte |= 0x80
+        out.append(byte)
+        if not n:
+            return bytes(out)
+
+
+def mqtt_str(data: bytes) -> bytes:
+    return struct.pack("!H", len(data)) + data
+
+
+def topic_matches(topic_filter: str, topic: str) -> bool:
+    levels = topic.split("/")
+    for i, part in enumerate(topic_filter.split("/")):
+        if part == "#":
+            return True
+        if i >= len(levels) or part not in ("+", levels[i]):
+            return False
+    return len(topic_filter.split("/")) == len(levels)
+
+
+class Client:
+    def __init__(self, sock: socket.socket, addr):
+        self.sock = sock
+        self.name = "%s:%d" % addr
+        self.filters: list[str] = []
+        self.lock = threading.Lock()
+
+    def send(self, data: bytes) -> None:
+        with self.lock:
+            self.sock.sendall(data)
+
+    def recv_exact(self, n: int) -> bytes:
+        buf = bytearray()
+        while len(buf) < n:
+            chunk = self.sock.recv(n - len(buf))
+            if not chunk:
+                raise ConnectionError("closed")
+            buf.extend(chunk)
+        return bytes(buf)
+
+    def read_packet(self):
+        first = self.recv_exact(1)[0]
+        length = shift = 0
+        while True:
+            byte = self.recv_exact(1)[0]
+            length |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        return first >> 4, first & 0x0F, self.recv_exact(length)
+
+
+class StandinBroker:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.clients: list[Client] = []
+
+    def log(self, client: Client, fmt: str, *params) -> None:
+        print("%.3f %s %s" % (time.monotonic(), client.name, fmt % params),
+              flush=True)
+
+    def serve(self, client: Client) -> None:
+        try:
+            while True:
+                ptype, flags, body = client.read_packet()
+                if ptype == 1:      # CONNECT
+                    offset = 2 + struct.unpack_from("!H", body)[0]
+                    clean = bool(body[offset + 1] & 0x02)
+                    keepalive = struct.unpack_from("!H", body, offset + 2)[0]
+                    self.log(client, "CONNECT clean=%d keepalive=%d",
+                             clean, keepalive)
+                    client.send(b"\x20\x02\x00\x00")
+                elif ptype == 8:    # SUBSCRIBE
+                    packet_id = struct.unpack_from("!H", body)[0]
+                    offset, codes = 2, bytearray()
+                    while offset < len(body):
+                        n = struct.unpack_from("!H", body, offset)[0]
+                        client.filters.append(
+                            body[offset + 2:offset + 2 + n].decode())
+                        codes.append(min(body[offset + 2 + n], 1))
+                        offset += 3 + n
+                    self.log(client, "SUBSCRIBE %s", ", ".join(client.filters))
+                    client.send(b"\x90" + encode_length(2 + len(codes))
+                                + struct.pack("!H", packet_id) + codes)
+                elif ptype == 3:    # PUBLISH
+                    self.on_publish(client, flags, body)
+                elif ptype == 12:   # PINGREQ
+                    self.log(client, "PINGREQ")
+                    if not self.args.no_pingresp:
+                        client.send(b"\xd0\x00")
+                elif ptype == 14:   # DISCONNECT
+                    self.log(client, "DISCONNECT")
+                    break
+        except (ConnectionError, OSError):
+            pass
+        self.log(client, "closed")
+        self.clients.remove(client)
+        client.sock.close()
+
+    def on_publish(self, client: Client, flags: int, body: bytes) -> None:
+        qos = (flags >> 1) & 0x3
+        n = struct.unpack_from("!H", body)[0]
+        topic = body[2:2 + n].decode()
+        offset = 2 + n
+        packet_id = None
+        if qos:
+            packet_id = struct.unpack_from("!H", body, offset)[0]
+            offset += 2
+        self.log(client, "PUBLISH %s %r qos=%d id=%s dup=%d", topic,
+                 body[offset:].decode(errors="replace"), qos, packet_id,
+                 bool(flags & 0x08))
+        if qos != 1:
+            return
+        if self.rng.random() < self.args.drop_puback:
+            self.log(client, "  PUBACK %d dropped", packet_id)
+            return
+        puback = b"\x40\x02" + struct.pack("!H", packet_id)
+        if self.args.puback_delay:
+            threading.Timer(self.args.puback_delay, client.send,
+                            (puback,)).start()
+        else:
+            client.send(puback)
+
+    def publish(self, topic: str, payload: str) -> None:
+        body = mqtt_str(topic.encode()) + payload.encode()
+        packet = b"\x30" + encode_length(len(body)) + body
+        for client in list(self.clients):
+            if any(topic_matches(f, topic) for f in client.filters):
+                client.send(packet)
+
+    def run(self) -> None:
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((self.args.bind, self.args.port))
+        server.listen(8)
+        print("listening on %s:%d" % (self.args.bind, self.args.port),
+              flush=True)
+        threading.Thread(target=self.stdin_publisher, daemon=True).start()
+        while True:
+            sock, addr = server.accept()
+            client = Client(sock, addr)
+            self.clients.append(client)
+            threading.Thread(target=self.serve, args=(client,),
+                             daemon=True).start()
+
+    def stdin_publisher(self) -> None:
+        for line in sys.stdin:
+            topic, _, payload = line.strip().partition(" ")
+            if topic:
+                self.publish(topic, payload)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--bind", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--drop-puback", type=float, default=0.,
+                        help="probability of dropping each PUBACK")
+    parser.add_argument("--puback-delay", type=float, default=0.,
+                        help="seconds to delay each PUBACK")
+    parser.add_argument("--no-pingresp", action="store_true",
+                        help="never answer PINGREQ")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    try:
+        StandinBroker(args).run()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()